@@ -5,9 +5,7 @@
  Authors:
    yifengyou <842056007@qq.com>
 """
-import glob
 import os
-import random
 import re
 import shutil
 import subprocess
@@ -15,10 +13,70 @@ import sys
 import argparse
 import time
 
-import select
+import atexit
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import fcntl
+import functools
+import gzip
+import hashlib
+import http.client
+import json
+import lzma
+import selectors
+import signal
+import stat
+import statistics
+import tarfile
+import tempfile
+import threading
+import traceback
+import urllib.request
+import zlib
 
 CURRENT_VERSION = "0.2.0"
 DEBUG = False
+KDEV_CACHE_DIR = os.path.expanduser("~/.cache/kdev")
+NBD_LOCK_DIR = "/run/lock/kdev"
+# 已缓存的镜像在此间隔(秒)内不再查询上游校验文件
+IMAGE_CHECK_INTERVAL = 24 * 3600
+# 直接引导时initramfs中加载的驱动，用于挂载根分区及9p模块共享
+DIRECT_BOOT_MODULES = ["virtio_pci", "virtio_blk", "virtio_net", "ext4", "9pnet_virtio", "9p"]
+# 每个编译job预估内存，用于计算job预算
+MEM_PER_JOB_KB = 512 * 1024
+# 矩阵编译时每个目标至少分配的job数
+MATRIX_MIN_JOBS = 4
+# kdev bench boot统计的串口里程碑，按顺序匹配
+BOOT_MILESTONES = [
+    ("kernel", r"Linux version \S+"),
+    ("init", r"Run \S+ as init process"),
+    ("login", r"login:\s*$"),
+]
+# 编译日志检查点间隔(未压缩字节)、刷新到磁盘的间隔秒数及保留的编译次数
+LOG_CHECKPOINT_BYTES = 1024 * 1024
+LOG_SYNC_INTERVAL = 2
+LOG_KEEP = 20
+# 编译器错误及make失败目标
+LOG_ERROR_RE = re.compile(r'(^|[\s:])(fatal )?error:', re.I)
+LOG_TARGET_RE = re.compile(r'make(?:\[\d+\])?: \*\*\* \[(?:\S+:\d+: )?(.+?)\] Error')
+# 编译进度按CC/LD/AR行计数，非终端输出进度的间隔秒数
+PROGRESS_RE = re.compile(r'^(CC|LD|AR)(\s|\[)')
+PROGRESS_INTERVAL = 10
+# 无历史记录时tmpfs编译目录的预估大小(KB)
+TMPFS_DEFAULT_KB = 4 * 1024 * 1024
+# 源码目录大文件告警阈值
+HUGEFILE_SIZE = 100 * 1024 * 1024
+# 常驻编译容器心跳文件，位于workdir
+WARM_HEARTBEAT = ".kdev-warm"
+# --trace打开时记录的trace事件，None表示未开启
+TRACE_EVENTS = None
+TRACE_LOCK = threading.Lock()
+TRACE_START = time.perf_counter()
+# 本进程连接的nbd设备，退出时释放
+NBD_OWNED = {}
 
 KERNEL_BUILD_MAP = {
     "linux-2.0": {
@@ -160,6 +218,58 @@ KERNEL_BUILD_MAP = {
 }
 
 
+@contextlib.contextmanager
+def do_trace_span(name, cat, **kwargs):
+    # Chrome trace event的complete事件(ph=X)，yield出的dict可补充结束时的参数(如retcode)
+    if TRACE_EVENTS is None:
+        yield kwargs
+        return
+    start = time.perf_counter()
+    try:
+        yield kwargs
+    finally:
+        end = time.perf_counter()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round((start - TRACE_START) * 1e6, 3),
+            "dur": round((end - start) * 1e6, 3),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": kwargs,
+        }
+        with TRACE_LOCK:
+            TRACE_EVENTS.append(event)
+
+
+def do_trace_func(cat):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with do_trace_span(func.__name__, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def do_trace_save(path):
+    with TRACE_LOCK:
+        events = list(TRACE_EVENTS)
+    # 线程名元数据，主线程之外按出现顺序编号
+    tids = []
+    for event in events:
+        if event["tid"] not in tids:
+            tids.append(event["tid"])
+    meta = [{"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": "kdev " + " ".join(sys.argv[1:])}}]
+    for index, tid in enumerate(tids):
+        name = "main" if tid == threading.main_thread().ident else f"worker-{index}"
+        meta.append({"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid, "args": {"name": name}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": meta + events, "displayTimeUnit": "ms"}, f)
+    print(f"trace file : {path}")
+
+
 def check_python_version():
     current_python = sys.version_info[0]
     if current_python == 3:
@@ -192,12 +302,178 @@ def check_arch(args):
         print(f"The target arch is {args.arch} (auto-detect)")
 
 
+def check_build_dir(path, build_dir):
+    # O=输出目录: kdev的build目录，或编译时生成了source软链接的目录
+    return path == build_dir or os.path.islink(os.path.join(path, "source"))
+
+
+def do_scan_dir(path, names, cache, build_dir):
+    # names为None时遍历目录，否则只检查git列出的文件
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    # 目录mtime不变则目录项不变，跳过stat（文件原地增长不会被发现）
+    cached = cache.get(path)
+    if cached and cached["mtime"] == mtime and (names is not None or "dirs" in cached):
+        return cached
+    result = {"mtime": mtime, "huge": []}
+    if names is None:
+        result["dirs"] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != ".git" and not check_build_dir(entry.path, build_dir):
+                            result["dirs"].append(entry.name)
+                    elif entry.is_file(follow_symlinks=False):
+                        size = entry.stat(follow_symlinks=False).st_size
+                        if size > HUGEFILE_SIZE:
+                            result["huge"].append([entry.name, size])
+        except OSError:
+            return None
+    else:
+        for name in names:
+            try:
+                st = os.lstat(os.path.join(path, name))
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode) and st.st_size > HUGEFILE_SIZE:
+                result["huge"].append([name, st.st_size])
+    return result
+
+
 def check_src_hugefile(args):
     # github不支持直接推送100M+文件，尽量不要大文件
-    ret, _, _ = do_exe_cmd(["find", args.sourcedir, "-name", ".git", "-prune", "-type", "f", "-size", "+100M"],
-                           capture_output=True, text=True)
-    if ret == 0:
-        print("Warnning!find file large than 100MB")
+    sourcedir = args.sourcedir
+    build_dir = os.path.join(args.workdir, "build")
+    cache_file = os.path.join(KDEV_CACHE_DIR, "hugefile-" + hashlib.sha1(sourcedir.encode()).hexdigest()[:12] + ".json")
+    cache = {}
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    start = time.monotonic()
+    scanned = {}
+    # git仓库直接使用索引及未忽略的新文件，不需要遍历整个目录树
+    files = []
+    try:
+        ret, _, _, _ = do_run_cmd(["git", "-c", "core.quotepath=off", "-C", sourcedir, "ls-files",
+                                   "--cached", "--others", "--exclude-standard"],
+                                  on_stdout=files.append, tail_lines=1)
+    except OSError:
+        ret = 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        if ret == 0 and files:
+            groups = {}
+            for name in files:
+                if name:
+                    dirname, basename = os.path.split(os.path.join(sourcedir, name))
+                    groups.setdefault(dirname, []).append(basename)
+            skipped = {}
+
+            def skip(path):
+                # 跳过位于O=目录下的未跟踪文件
+                if path not in skipped:
+                    if len(path) <= len(sourcedir):
+                        skipped[path] = False
+                    else:
+                        skipped[path] = check_build_dir(path, build_dir) or skip(os.path.dirname(path))
+                return skipped[path]
+
+            dirs = [d for d in groups if not skip(d)]
+            for path, result in zip(dirs, executor.map(lambda d: do_scan_dir(d, groups[d], cache, build_dir), dirs)):
+                if result is not None:
+                    scanned[path] = result
+        else:
+            # 非git仓库，按目录层级并行遍历
+            frontier = [sourcedir]
+            while frontier:
+                results = list(executor.map(lambda d: do_scan_dir(d, None, cache, build_dir), frontier))
+                next_frontier = []
+                for path, result in zip(frontier, results):
+                    if result is None:
+                        continue
+                    scanned[path] = result
+                    next_frontier += [os.path.join(path, d) for d in result["dirs"]]
+                frontier = next_frontier
+
+    try:
+        os.makedirs(KDEV_CACHE_DIR, exist_ok=True)
+        tmpfile = f"{cache_file}.{os.getpid()}"
+        with open(tmpfile, "w") as f:
+            json.dump(scanned, f)
+        os.replace(tmpfile, cache_file)
+    except OSError as e:
+        pdebug(f"write {cache_file} failed: {e}")
+
+    hugefiles = []
+    for path, result in scanned.items():
+        hugefiles += [(os.path.join(path, name), size) for name, size in result["huge"]]
+    pdebug(f"scan {len(scanned)} dirs in {sourcedir} took {time.monotonic() - start:.3f}s")
+    if hugefiles:
+        pwarn(f"find {len(hugefiles)} file(s) large than {HUGEFILE_SIZE // 1024 // 1024}MB in {sourcedir}")
+        for path, size in sorted(hugefiles):
+            print(f"  {size // 1024 // 1024:>6}MB {path}")
+    return hugefiles
+
+
+def check_makefile_version(makefile):
+    # 版本定义位于顶层Makefile开头，与make kernelversion拼接规则一致
+    fields = {}
+    with open(makefile, "r", errors="replace") as f:
+        for _ in range(64):
+            line = f.readline()
+            if not line:
+                break
+            match = re.match(r'^(VERSION|PATCHLEVEL|SUBLEVEL|EXTRAVERSION)\s*=\s*(\S*)', line)
+            if match:
+                fields[match.group(1)] = match.group(2)
+    if not fields.get("VERSION", "").isdigit():
+        return None
+    version = fields["VERSION"]
+    if fields.get("PATCHLEVEL"):
+        version += "." + fields["PATCHLEVEL"]
+        if fields.get("SUBLEVEL"):
+            version += "." + fields["SUBLEVEL"]
+    return version + fields.get("EXTRAVERSION", "")
+
+
+def check_kernel_version(sourcedir):
+    # 以Makefile路径+inode+mtime缓存版本号，避免每个子命令都解析或执行make
+    makefile = os.path.join(sourcedir, "Makefile")
+    st = os.stat(makefile)
+    key = f"{makefile}:{st.st_ino}:{st.st_mtime_ns}:{st.st_size}"
+    cache_file = os.path.join(KDEV_CACHE_DIR, "kernelversion.json")
+    cache = {}
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if cache.get(makefile, {}).get("key") == key:
+        return cache[makefile]["version"]
+
+    version = check_makefile_version(makefile)
+    if version is None:
+        pdebug(f"parse version from {makefile} failed, fallback to make kernelversion")
+        ret, output, _ = do_exe_cmd(["make", "-s", "-C", sourcedir, "kernelversion"])
+        if ret != 0:
+            perror(f"Unsupported {output}")
+        version = output.strip()
+
+    cache[makefile] = {"key": key, "version": version}
+    try:
+        os.makedirs(KDEV_CACHE_DIR, exist_ok=True)
+        tmpfile = f"{cache_file}.{os.getpid()}"
+        with open(tmpfile, "w") as f:
+            json.dump(cache, f, indent=4)
+        os.replace(tmpfile, cache_file)
+    except OSError as e:
+        pdebug(f"write {cache_file} failed: {e}")
+    return version
 
 
 def check_docker_image(args):
@@ -228,63 +504,1472 @@ def check_qcow_image(args):
     return False, ''
 
 
-def do_exe_cmd(cmd, enable_log=False, logfile="build-kernel.log", print_output=False, shell=False):
-    stdout_output = ''
-    stderr_output = ''
+def check_build_mode(args, fingerprint):
+    # full: mrproper + defconfig; config: 仅defconfig; incremental: 直接make
+    if args.rebuild:
+        return "full"
+    if not os.path.isfile(os.path.join(args.workdir, "build", ".config")):
+        return "full"
+    try:
+        with open(os.path.join(args.workdir, "build.fingerprint"), "r") as f:
+            last = json.load(f)
+    except (OSError, ValueError):
+        return "full"
+    # 架构、交叉编译器或编译镜像变化后目标文件不可复用
+    for key in ["arch", "cross_compile", "toolchain"]:
+        if last.get(key) != fingerprint[key]:
+            pdebug(f"fingerprint {key} changed: {last.get(key)} -> {fingerprint[key]}")
+            return "full"
+    for key in ["config", "config_digest", "module_compress"]:
+        if last.get(key) != fingerprint[key]:
+            pdebug(f"fingerprint {key} changed: {last.get(key)} -> {fingerprint[key]}")
+            return "config"
+    return "incremental"
+
+
+def check_kernel_version_tuple(kernelversion):
+    match = re.match(r'(\d+)\.(\d+)', kernelversion)
+    if not match:
+        return (0, 0)
+    return int(match.group(1)), int(match.group(2))
+
+
+def check_module_compress(args):
+    # 5.13+支持MODULE_COMPRESS_ZSTD，3.18~5.12仅支持MODULE_COMPRESS+GZIP/XZ，5.17+支持内核内解压
+    if not args.module_compress or args.module_compress == "none":
+        return None, ""
+    version = check_kernel_version_tuple(args.kernelversion)
+    if version < (3, 18):
+        pwarn(f"kernel {args.kernelversion} does not support module compression")
+        return None, ""
+    algo = args.module_compress
+    if algo == "auto":
+        algo = "zstd" if version >= (5, 13) else "xz"
+    if algo == "zstd" and version < (5, 13):
+        pwarn(f"kernel {args.kernelversion} does not support zstd module compression, use xz")
+        algo = "xz"
+    choices = ["GZIP", "XZ", "ZSTD"] if version >= (5, 13) else ["GZIP", "XZ"]
+    opts = ["--enable", "MODULE_COMPRESS_" + algo.upper()]
+    opts += [o for c in choices if c != algo.upper() for o in ["--disable", "MODULE_COMPRESS_" + c]]
+    if version >= (5, 13):
+        opts += ["--disable", "MODULE_COMPRESS_NONE"]
+    else:
+        opts = ["--enable", "MODULE_COMPRESS"] + opts
+    if version >= (5, 17):
+        opts += ["--enable", "MODULE_DECOMPRESS"]
+    return algo, " ".join(opts)
+
+
+def check_config_module_compress(args):
+    # 以最终.config为准，依赖不满足时olddefconfig会回退
+    config = os.path.join(args.workdir, "build", ".config")
+    if not os.path.isfile(config):
+        return None
+    with open(config, "r", errors="replace") as f:
+        for line in f:
+            match = re.match(r'^CONFIG_MODULE_COMPRESS_(GZIP|XZ|ZSTD)=y', line)
+            if match:
+                return match.group(1).lower()
+    return None
+
+
+def do_build_fingerprint(args, kernel_config):
+    srcarch = "x86" if args.arch == "x86_64" else args.arch
+    config_digest = ''
+    defconfig = os.path.join(args.sourcedir, "arch", srcarch, "configs", kernel_config)
+    if os.path.isfile(defconfig):
+        with open(defconfig, "rb") as f:
+            config_digest = hashlib.sha256(f.read()).hexdigest()
+    return {
+        "arch": args.arch,
+        "cross_compile": args.cross_compile,
+        "toolchain": "host" if args.nodocker else args.docker_image,
+        "config": kernel_config,
+        "config_digest": config_digest,
+        "module_compress": args.module_compress_algo,
+    }
+
+
+def do_save_build_fingerprint(args, fingerprint):
+    with open(os.path.join(args.workdir, "build.fingerprint"), "w") as f:
+        json.dump(fingerprint, f, indent=4)
+
+
+def do_run_cmd(cmd, on_stdout=None, on_stderr=None, tail_lines=200, shell=False, cwd=None, env=None,
+               on_chunk=None, timeout=None, stdin=None):
+    # 按块读取stdout/stderr直到EOF，逐行回调，仅保留最后tail_lines行用于错误报告
+    # on_chunk收到stdout原始数据块(不等待换行)；任一回调返回True或超时则杀掉进程
+    name = cmd if isinstance(cmd, str) else " ".join(cmd)
+    with do_trace_span(os.path.basename(name.split()[0]) if name else "cmd", "cmd", cmd=name) as span:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell, cwd=cwd, env=env,
+                             stdin=stdin)
+        streams = {
+            p.stdout: [on_stdout, collections.deque(maxlen=tail_lines), b''],
+            p.stderr: [on_stderr, collections.deque(maxlen=tail_lines), b''],
+        }
+        sel = selectors.DefaultSelector()
+        for f in streams:
+            sel.register(f, selectors.EVENT_READ)
+        deadline = time.monotonic() + timeout if timeout else None
+        stop = False
+        killed = False
+        while sel.get_map():
+            if deadline is not None and not stop and time.monotonic() >= deadline:
+                pdebug(f"cmd timeout after {timeout}s, kill it")
+                stop = True
+                deadline = None
+            if stop and not killed:
+                # 只发送一次，不能poll回收子进程，否则之后wait4返回ECHILD
+                try:
+                    os.kill(p.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                killed = True
+            events = sel.select(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            for key, _ in events:
+                f = key.fileobj
+                callback, tail, pending = streams[f]
+                chunk = os.read(f.fileno(), 65536)
+                if chunk and on_chunk is not None and f is p.stdout and not stop:
+                    stop = bool(on_chunk(chunk))
+                if chunk:
+                    lines = (pending + chunk).split(b'\n')
+                    streams[f][2] = lines.pop()
+                else:
+                    # EOF，输出最后不完整的一行
+                    sel.unregister(f)
+                    f.close()
+                    lines = [pending] if pending else []
+                for raw in lines:
+                    line = raw.decode('utf-8', errors='replace').rstrip('\r')
+                    tail.append(line)
+                    if callback is not None and callback(line) is True:
+                        stop = True
+        sel.close()
+        # 使用wait4获取子进程树的资源统计
+        _, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = os.waitstatus_to_exitcode(status)
+        span["retcode"] = p.returncode
+        return p.returncode, list(streams[p.stdout][1]), list(streams[p.stderr][1]), rusage
+
+
+def check_rootfs_image(args):
+    ok, image_url = check_qcow_image(args)
+    if not ok:
+        perror(" no available image found!")
+    print(f" using qcows url {image_url}")
+
+    args.qcow2_url = image_url
+    args.qcow2 = os.path.basename(image_url)
+    print(f" qcow2 name : {args.qcow2}")
+    # 每个虚机使用独立的overlay，下载的镜像作为只读backing file
+    if not hasattr(args, "name") or args.name is None:
+        args.name = f"linux-{args.masterversion}-{args.arch}"
+    args.overlay = os.path.join(args.workdir, f"{args.name}.qcow2")
+    print(f" qcow2 overlay : {args.overlay}")
+
+
+def check_image_checksum(url):
+    # 从镜像所在目录的SHA512SUMS/SHA256SUMS获取校验值，找不到则返回空
+    base_url, filename = url.rsplit("/", 1)
+    for sums, algo in [("SHA512SUMS", "sha512"), ("SHA256SUMS", "sha256")]:
+        try:
+            with urllib.request.urlopen(f"{base_url}/{sums}", timeout=30) as resp:
+                content = resp.read().decode("utf-8", errors="replace")
+        except (OSError, ValueError, http.client.HTTPException):
+            continue
+        for line in content.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1].lstrip("*") == filename:
+                return algo, fields[0].lower()
+    return None, None
+
+
+def do_hash_file(path, algo):
+    h = hashlib.new(algo)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def do_fetch_url(url, dest, threads=4, chunk_size=16 * 1024 * 1024):
+    # 支持Range时多线程分块下载，每块完成后记录状态，中断后只重新下载未完成的块
+    part = dest + ".part"
+    state_file = dest + ".part.json"
+    length = 0
+    accept_ranges = False
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method="HEAD"), timeout=30) as resp:
+            length = int(resp.headers.get("Content-Length") or 0)
+            accept_ranges = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        pdebug(f"HEAD {url} failed: {e}")
+
+    if not accept_ranges or length == 0:
+        print(f" server does not support range requests, single stream download {url}")
+        with urllib.request.urlopen(url, timeout=60) as resp, open(part, "wb") as f:
+            shutil.copyfileobj(resp, f, 4 * 1024 * 1024)
+        os.rename(part, dest)
+        return
+
+    chunks = [(offset, min(offset + chunk_size, length) - 1) for offset in range(0, length, chunk_size)]
+    done = set()
+    if os.path.isfile(part) and os.path.isfile(state_file):
+        try:
+            with open(state_file, "r") as f:
+                state = json.load(f)
+            if state.get("url") == url and state.get("length") == length and state.get("chunk_size") == chunk_size:
+                done = set(state["done"])
+        except (OSError, ValueError, KeyError):
+            done = set()
+    if done:
+        print(f" resume download, {len(done)}/{len(chunks)} chunks already done")
+    fd = os.open(part, os.O_RDWR | os.O_CREAT, 0o644)
+    os.ftruncate(fd, length)
+    lock = threading.Lock()
+
+    def fetch_chunk(index):
+        start, end = chunks[index]
+        for retry in range(3):
+            try:
+                req = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}"})
+                with urllib.request.urlopen(req, timeout=60) as resp:
+                    if resp.status != 206:
+                        raise OSError(f"unexpected http status {resp.status}")
+                    offset = start
+                    while True:
+                        data = resp.read(1024 * 1024)
+                        if not data:
+                            break
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                if offset != end + 1:
+                    raise OSError(f"short read {offset - start}/{end - start + 1}")
+                break
+            except (OSError, http.client.HTTPException) as e:
+                if retry == 2:
+                    raise
+                pwarn(f"download chunk {index} failed, retry: {e}")
+        with lock:
+            done.add(index)
+            with open(state_file, "w") as f:
+                json.dump({"url": url, "length": length, "chunk_size": chunk_size, "done": sorted(done)}, f)
+            print(f" downloaded {len(done)}/{len(chunks)} chunks", flush=True)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            for future in [executor.submit(fetch_chunk, i) for i in range(len(chunks)) if i not in done]:
+                future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(part, dest)
+    os.remove(state_file)
+
+
+@do_trace_func("copy")
+def do_download_image(url, cache_dir, threads=4):
+    # 镜像缓存按url及官方校验值区分，上游发布新镜像(如latest)时使用新的缓存项，
+    # 旧镜像保留，以其为backing file的overlay不受影响；多个workdir共享同一份
+    url_dir = os.path.join(cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest()[:16])
+    name = os.path.basename(url)
+    os.makedirs(url_dir, exist_ok=True)
+    # 最近校验过的缓存项，兼容只按url区分的旧缓存
+    entries = [url_dir] + [os.path.join(url_dir, d) for d in os.listdir(url_dir)]
+    entries = [os.path.join(d, name + ".verified") for d in entries]
+    entries = [f for f in entries if os.path.isfile(f) and os.path.isfile(f[:-len(".verified")])]
+    latest = os.path.dirname(max(entries, key=lambda f: os.stat(f).st_mtime)) if entries else None
+    checked_file = os.path.join(url_dir, "checked")
+
+    algo, digest = None, None
+    if latest and os.path.isfile(checked_file) and \
+            time.time() - os.stat(checked_file).st_mtime < IMAGE_CHECK_INTERVAL:
+        # 近期查询过上游，直接使用缓存，不依赖网络
+        entry_dir = latest
+    else:
+        algo, digest = check_image_checksum(url)
+        if digest:
+            entry_dir = os.path.join(url_dir, digest[:16])
+        else:
+            # 镜像源没有校验文件(或无法访问)时按url区分，优先使用最近校验过的缓存项
+            entry_dir = latest or url_dir
+    os.makedirs(entry_dir, exist_ok=True)
+    path = os.path.join(entry_dir, name)
+    verified_file = path + ".verified"
+
+    # 多个workdir并发下载同一镜像时串行，后者等待后直接命中缓存
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print(f" wait for another kdev downloading {name}")
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+        if os.path.isfile(path) and os.path.isfile(verified_file):
+            st = os.stat(path)
+            with open(verified_file, "r") as f:
+                verified = json.load(f)
+            if verified.get("size") == st.st_size and verified.get("mtime_ns") == st.st_mtime_ns and \
+                    (digest is None or verified.get(algo) == digest):
+                print(f" image cache hit {path}")
+                if digest:
+                    with open(checked_file, "w"):
+                        pass
+                return path
+
+        if os.path.isfile(path):
+            print(f" verify cached image {path}")
+        else:
+            print(f" start to download {url} to {path}")
+            try:
+                do_fetch_url(url, path, threads=threads)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                perror(f"Download qcow2 failed! {e}")
+        if algo is None:
+            # 无官方校验文件时记录本地sha256，之后以大小和mtime判断是否被修改
+            pwarn(f"no checksum found for {url}, skip verify")
+            algo, digest = "sha256", do_hash_file(path, "sha256")
+        elif do_hash_file(path, algo) != digest:
+            os.remove(path)
+            perror(f"checksum mismatch {path}, removed, try again!")
+        else:
+            with open(checked_file, "w"):
+                pass
+        os.chmod(path, 0o444)
+        st = os.stat(path)
+        with open(verified_file, "w") as f:
+            json.dump({"url": url, algo: digest, "size": st.st_size, "mtime_ns": st.st_mtime_ns}, f, indent=4)
+        print(f" image verified {algo}:{digest}")
+        return path
+    finally:
+        os.close(fd)
+
+
+@do_trace_func("copy")
+def do_link_image(src, dst):
+    # 优先硬链接，跨文件系统时尝试reflink，最后退化为软链接，避免拷贝
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        print(f" hardlink {src} -> {dst}")
+        return
+    except OSError as e:
+        pdebug(f"hardlink failed: {e}")
+    retcode, _, _ = do_exe_cmd(["cp", "--reflink=always", src, dst])
+    if retcode == 0:
+        print(f" reflink {src} -> {dst}")
+        return
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.symlink(src, dst)
+    print(f" symlink {src} -> {dst}")
+
+
+def do_exe_cmd(cmd, enable_log=False, logfile="build-kernel.log", print_output=False, shell=False, tail_lines=1000):
     if isinstance(cmd, str):
         cmd = cmd.split()
     elif isinstance(cmd, list):
         pass
     else:
         raise Exception("unsupported type when run do_exec_cmd", type(cmd))
+    log_file = None
     if enable_log:
         log_file = open(logfile, "w+")
+
+    def make_callback(tag):
+        def callback(line):
+            line = line.strip()
+            if not line:
+                return
+            if print_output:
+                print(tag, line, flush=True)
+            if log_file is not None:
+                log_file.write(line + "\n")
+        return callback
+
     pdebug("Run cmd:" + " ".join(cmd))
-    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=shell)
-    while True:
-        # 使用select模块，监控stdout和stderr的可读性，设置超时时间为0.1秒
-        rlist, _, _ = select.select([p.stdout, p.stderr], [], [], 0.1)
-        # 遍历可读的文件对象
-        for f in rlist:
-            # 读取一行内容，解码为utf-8
-            line = f.readline().decode('utf-8').strip()
-            # 如果有内容，判断是stdout还是stderr，并打印到屏幕，并刷新缓冲区
-            if line:
-                if f == p.stdout:
-                    if print_output == True:
-                        print("STDOUT", line)
-                    if enable_log:
-                        log_file.write(line + "\n")
-                    stdout_output += line + '\n'
-                    sys.stdout.flush()
-                elif f == p.stderr:
-                    if print_output == True:
-                        print("STDERR", line)
-                    if enable_log:
-                        log_file.write(line + "\n")
-                    stderr_output += line + '\n'
-                    sys.stderr.flush()
-        if p.poll() is not None:
+    try:
+        ret, stdout_tail, stderr_tail, _ = do_run_cmd(cmd,
+                                                   on_stdout=make_callback("STDOUT"),
+                                                   on_stderr=make_callback("STDERR"),
+                                                   tail_lines=tail_lines,
+                                                   shell=shell)
+    finally:
+        # 关闭日志描述符
+        if log_file is not None:
+            log_file.close()
+
+    stdout_output = ''.join(line + '\n' for line in stdout_tail)
+    stderr_output = ''.join(line + '\n' for line in stderr_tail)
+    return ret, stdout_output, stderr_output
+
+
+def check_nbd_devices():
+    if not os.path.isdir("/sys/block/nbd0"):
+        do_exe_cmd(["modprobe", "nbd", "max_part=19"], print_output=True)
+    nbds = [entry for entry in os.listdir("/sys/block/") if re.match(r'nbd\d+$', entry)]
+    return sorted(nbds, key=lambda nbd: int(nbd[3:]))
+
+
+def check_nbd_image(nbd):
+    # 通过qemu-nbd进程命令行获取设备连接的镜像，未连接返回None
+    try:
+        with open(f"/sys/block/{nbd}/pid", "r") as f:
+            pid = f.read().strip()
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read().split(b'\0')
+    except OSError:
+        return None if not os.path.exists(f"/sys/block/{nbd}/pid") else ''
+    for arg in cmdline[1:]:
+        arg = arg.decode("utf-8", errors="replace")
+        if os.path.isfile(arg):
+            return os.path.abspath(arg)
+    return ''
+
+
+def check_nbd_ready(nbd, timeout=10.0):
+    # 轮询设备大小及分区节点，替代固定sleep
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with open(f"/sys/block/{nbd}/size", "r") as f:
+                size = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            size = 0
+        if size > 0 and os.path.exists(f"/dev/{nbd}p1"):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def check_pid_alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except (ProcessLookupError, ValueError, TypeError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def check_nbd_mounts(nbd):
+    # 设备及其分区仍挂载的目录，深层目录在前便于依次卸载
+    mounts = []
+    with open("/proc/self/mounts", "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 1 and re.match(rf'^/dev/{nbd}(p\d+)?$', fields[0]):
+                mounts.append(re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1]))
+    return sorted(mounts, key=len, reverse=True)
+
+
+def do_nbd_record(fd, record):
+    os.ftruncate(fd, 0)
+    if record:
+        os.pwrite(fd, json.dumps(record).encode("utf-8"), 0)
+
+
+@do_trace_func("nbd")
+def do_nbd_connect(image, nbd=None, readonly=False, persistent=False, discard=False):
+    # 每个nbd设备对应一个锁文件，持有排他锁才能使用；锁文件记录连接者，用于回收崩溃进程遗留的设备
+    image = os.path.abspath(image)
+    os.makedirs(NBD_LOCK_DIR, exist_ok=True)
+    candidates = [nbd] if nbd else check_nbd_devices()
+    for nbd in candidates:
+        fd = os.open(os.path.join(NBD_LOCK_DIR, f"{nbd}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        try:
+            record = json.loads(os.pread(fd, 4096, 0) or b'{}')
+        except ValueError:
+            record = {}
+        if check_nbd_image(nbd) is not None:
+            if record and not record.get("persistent") and not check_pid_alive(record.get("owner")):
+                pwarn(f"reclaim /dev/{nbd} left by exited kdev process {record.get('owner')}")
+                # 崩溃进程遗留的挂载必须先卸载，否则换接镜像后旧挂载的回写会破坏新镜像
+                stale = [m for m in check_nbd_mounts(nbd)
+                         if do_exe_cmd(["umount", m], print_output=True)[0] != 0]
+                if stale:
+                    pwarn(f"/dev/{nbd} still mounted on {', '.join(stale)}, skip it")
+                    os.close(fd)
+                    continue
+                do_exe_cmd(["qemu-nbd", "--disconnect", f"/dev/{nbd}"], print_output=True)
+            else:
+                os.close(fd)
+                continue
+        cmd = ["qemu-nbd", "--connect", f"/dev/{nbd}", image]
+        if readonly:
+            cmd.insert(1, "--read-only")
+        if discard:
+            # fstrim释放的块在qcow2中同步释放
+            cmd.insert(1, "--discard=unmap")
+        retcode, _, error = do_exe_cmd(cmd, print_output=True)
+        if retcode != 0:
+            pdebug(f"connect /dev/{nbd} failed: {error}")
+            os.close(fd)
+            continue
+        do_nbd_record(fd, {"owner": os.getpid(), "image": image, "persistent": bool(persistent)})
+        if not check_nbd_ready(nbd):
+            do_exe_cmd(["qemu-nbd", "--disconnect", f"/dev/{nbd}"], print_output=True)
+            do_nbd_record(fd, None)
+            os.close(fd)
+            perror(f"/dev/{nbd} partitions not ready!")
+        if persistent:
+            # kdev image -m 退出后仍保持连接，由 kdev image -u 释放
+            os.close(fd)
+        else:
+            if not NBD_OWNED:
+                atexit.register(do_nbd_release_all)
+            NBD_OWNED[nbd] = {"fd": fd, "mounts": []}
+        print(f" connect {image} to /dev/{nbd}")
+        return nbd
+    perror("No available nbd found!")
+
+
+@do_trace_func("nbd")
+def do_nbd_mount(nbd, mntdir, options="rw"):
+    retcode, _, error = do_exe_cmd(["mount", "-o", options, f"/dev/{nbd}p1", mntdir], print_output=True)
+    if retcode != 0:
+        return retcode
+    if nbd in NBD_OWNED:
+        NBD_OWNED[nbd]["mounts"].append(mntdir)
+    return 0
+
+
+@do_trace_func("nbd")
+def do_nbd_disconnect(nbd):
+    owned = NBD_OWNED.pop(nbd, None)
+    if owned is not None:
+        for mntdir in owned["mounts"]:
+            if os.path.ismount(mntdir):
+                do_exe_cmd(["umount", "-l", mntdir], print_output=True)
+    retcode, _, _ = do_exe_cmd(["qemu-nbd", "--disconnect", f"/dev/{nbd}"], print_output=True)
+    if owned is not None:
+        fd = owned["fd"]
+    else:
+        fd = os.open(os.path.join(NBD_LOCK_DIR, f"{nbd}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    do_nbd_record(fd, None)
+    os.close(fd)
+    return retcode
+
+
+def do_nbd_release_all():
+    # 异常退出时只释放本进程连接的nbd设备
+    for nbd in list(NBD_OWNED):
+        pwarn(f"release /dev/{nbd}")
+        do_nbd_disconnect(nbd)
+
+
+def do_nbd_find(image):
+    image = os.path.abspath(image)
+    for nbd in check_nbd_devices():
+        if check_nbd_image(nbd) == image:
+            return nbd
+    return None
+
+
+def do_log_open(path):
+    # gzip流式压缩，定期full flush记录检查点，可从检查点直接解压读取
+    state = {
+        "file": open(path, "wb"),
+        "zobj": zlib.compressobj(6, zlib.DEFLATED, 31),
+        "offset": 0,
+        "lines": 0,
+        "pending": 0,
+        "synced": time.monotonic(),
+        "index": {"log": os.path.basename(path), "lines": 0, "checkpoints": [],
+                  "first_error": None, "failed_target": None},
+    }
+    do_log_checkpoint(state)
+    return state
+
+
+def do_log_checkpoint(state):
+    data = state["zobj"].flush(zlib.Z_FULL_FLUSH)
+    state["file"].write(data)
+    state["offset"] += len(data)
+    state["pending"] = 0
+    state["index"]["checkpoints"].append([state["lines"], state["offset"]])
+
+
+def do_log_write(state, tag, line):
+    if state["pending"] >= LOG_CHECKPOINT_BYTES:
+        do_log_checkpoint(state)
+    index = state["index"]
+    if index["first_error"] is None and LOG_ERROR_RE.search(line):
+        index["first_error"] = state["lines"]
+    if index["failed_target"] is None:
+        match = LOG_TARGET_RE.search(line)
+        if match:
+            index["failed_target"] = {"line": state["lines"], "target": match.group(1)}
+    now = time.time()
+    stamp = time.strftime("%H:%M:%S", time.localtime(now)) + f".{int(now * 1000) % 1000:03d}"
+    data = f"{stamp} {tag} {line}\n".encode("utf-8", errors="replace")
+    out = state["zobj"].compress(data)
+    state["file"].write(out)
+    state["offset"] += len(out)
+    state["pending"] += len(data)
+    state["lines"] += 1
+    # 错误输出及定时sync flush，编译被杀或仍在编译时日志也可读到最后的输出
+    if tag == "STDERR" or time.monotonic() - state["synced"] >= LOG_SYNC_INTERVAL:
+        do_log_sync(state)
+
+
+def do_log_sync(state):
+    data = state["zobj"].flush(zlib.Z_SYNC_FLUSH)
+    state["file"].write(data)
+    state["file"].flush()
+    state["offset"] += len(data)
+    state["synced"] = time.monotonic()
+
+
+def do_log_close(state):
+    state["file"].write(state["zobj"].flush())
+    state["file"].close()
+    state["index"]["lines"] = state["lines"]
+    return state["index"]
+
+
+def do_log_read(path, index, first, last):
+    # 从first之前最近的检查点开始解压，只读取[first, last)行
+    line_no, offset = index["checkpoints"][0]
+    for cp_line, cp_offset in index["checkpoints"]:
+        if cp_line > first:
             break
+        line_no, offset = cp_line, cp_offset
+    lines = []
+    decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+    pending = b''
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while line_no < last and not decomp.eof:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            parts = (pending + decomp.decompress(chunk)).split(b'\n')
+            pending = parts.pop()
+            for raw in parts:
+                if first <= line_no < last:
+                    lines.append(raw.decode("utf-8", errors="replace"))
+                line_no += 1
+    return lines[:last - first]
+
+
+def do_log_iter(path):
+    # 编译中断或仍在编译的日志没有gzip结尾，解压到已写入的数据为止
+    decomp = zlib.decompressobj(31)
+    pending = b''
+    with open(path, "rb") as f:
+        while not decomp.eof:
+            chunk = f.read(65536)
+            if not chunk:
+                break
+            try:
+                data = decomp.decompress(chunk)
+            except zlib.error as e:
+                pwarn(f"{path} is corrupted: {e}")
+                break
+            parts = (pending + data).split(b'\n')
+            pending = parts.pop()
+            for raw in parts:
+                yield raw.decode("utf-8", errors="replace")
+    if pending:
+        yield pending.decode("utf-8", errors="replace")
+
+
+def check_log_index(path):
+    # 编译中断时没有索引，完整扫描一次日志重建
+    index = {"log": os.path.basename(path), "lines": 0, "checkpoints": [[0, 0]],
+             "first_error": None, "failed_target": None}
+    for line_no, line in enumerate(do_log_iter(path)):
+        text = line.split(" ", 2)[-1]
+        if index["first_error"] is None and LOG_ERROR_RE.search(text):
+            index["first_error"] = line_no
+        if index["failed_target"] is None:
+            match = LOG_TARGET_RE.search(text)
+            if match:
+                index["failed_target"] = {"line": line_no, "target": match.group(1)}
+        index["lines"] = line_no + 1
+    return index
+
+
+def do_print_log_errors(logdir, index, context=10):
+    path = os.path.join(logdir, index["log"])
+    if index.get("checkpoints") == [[0, 0]]:
+        index = check_log_index(path)
+
+        def read(first, last):
+            return [line for line_no, line in enumerate(do_log_iter(path)) if first <= line_no < last]
+    else:
+        def read(first, last):
+            return do_log_read(path, index, first, last)
+
+    if index["failed_target"]:
+        print(f" failed target : {index['failed_target']['target']} (line {index['failed_target']['line'] + 1})")
+    error = index["first_error"]
+    if error is None and index["failed_target"]:
+        error = index["failed_target"]["line"]
+    if error is None:
+        # 没有编译错误，输出日志结尾
+        error = max(0, index["lines"] - context)
+    print(f" first error at line {error + 1} of {path}")
+    first = max(0, error - context)
+    for line_no, line in enumerate(read(first, error + context + 1), first):
+        print(f"{'>' if line_no == error else ' '}{line_no + 1:>8} {line}")
+
+
+def check_kbuild_objects(args):
+    # 按.config粗略统计Makefile/Kbuild中会编译的.o数量(obj-y/obj-m及复合对象)
+    config = {}
+    config_file = os.path.join(args.workdir, "build", ".config")
+    if os.path.isfile(config_file):
+        with open(config_file, "r", errors="replace") as f:
+            for line in f:
+                match = re.match(r'^CONFIG_(\w+)=([ym])', line)
+                if match:
+                    config[match.group(1)] = match.group(2)
+    pattern = re.compile(r'^\s*[\w.-]+-(y|m|objs|\$\(CONFIG_(\w+)\))\s*[+:]?=(.*)')
+    total = 0
+    for root, dirs, files in os.walk(args.sourcedir):
+        dirs[:] = [d for d in dirs if d not in [".git", "Documentation", "tools", "samples"]
+                   and not os.path.islink(os.path.join(root, d, "source"))]
+        for name in files:
+            if name not in ["Makefile", "Kbuild"]:
+                continue
+            try:
+                with open(os.path.join(root, name), "r", errors="replace") as f:
+                    text = f.read().replace("\\\n", " ")
+            except OSError:
+                continue
+            for line in text.splitlines():
+                match = pattern.match(line)
+                if match and (match.group(2) is None or match.group(2) in config):
+                    total += sum(1 for word in match.group(3).split() if word.endswith(".o"))
+    return total
+
+
+def check_progress_total(args):
+    # 上次全量编译的对象数最准确，否则根据.config及Kbuild估算；增量编译无法预估
+    if args.build_mode == "incremental":
+        return None
+    try:
+        with open(os.path.join(args.workdir, "kdev-build-report.json"), "r") as f:
+            last = json.load(f)
+        if last.get("build_mode") == "full" and last.get("config") == args.kernel_config:
+            for result in last.get("phases", []):
+                if result.get("name") == "build" and result.get("retcode") == 0 and result.get("objects"):
+                    return result["objects"]
+    except (OSError, ValueError):
+        pass
+    return check_kbuild_objects(args) or None
+
+
+def do_progress_new(args, phase, total):
+    return {
+        "args": args,
+        "phase": phase,
+        "total": total,
+        "done": 0,
+        "start": time.monotonic(),
+        "start_time": time.time(),
+        "shown": 0.0,
+        # 多个矩阵目标在线程中并发编译，不输出进度行
+        "show": not args.matrix,
+        "tty": sys.stdout.isatty() and args.quiet,
+    }
 
-    # 关闭日志描述符
-    if enable_log:
-        log_file.close()
 
-    return p.returncode, stdout_output, stderr_output
+def do_progress_line(progress, line):
+    if not PROGRESS_RE.match(line):
+        return
+    progress["done"] += 1
+    now = time.monotonic()
+    # 非终端每10秒输出一行，终端每秒刷新一次
+    interval = 1.0 if progress["tty"] else PROGRESS_INTERVAL
+    if now - progress["shown"] >= interval:
+        progress["shown"] = now
+        do_progress_show(progress)
+
+
+def check_progress_stats(progress):
+    elapsed = max(0.001, time.monotonic() - progress["start"])
+    rate = progress["done"] / elapsed
+    total = progress["total"]
+    if total and progress["done"] > total:
+        # 预估偏小，按已完成数修正
+        total = progress["done"]
+    ratio = progress["done"] / total if total else None
+    eta = (total - progress["done"]) / rate if total and rate > 0 else None
+    return rate, total, ratio, eta
+
+
+def do_progress_show(progress, final=False):
+    rate, total, ratio, eta = check_progress_stats(progress)
+    if progress["show"]:
+        text = f" [{progress['phase']}] "
+        if ratio is not None:
+            text += f"{ratio * 100:5.1f}% {progress['done']}/{total} objs"
+        else:
+            text += f"{progress['done']} objs"
+        text += f" {rate:.1f} obj/s"
+        if eta is not None and not final:
+            text += f" ETA {int(eta) // 60}m{int(eta) % 60:02d}s"
+        if progress["tty"]:
+            print("\r" + text.ljust(72), end="\n" if final else "", flush=True)
+        else:
+            print(text, flush=True)
+    if progress["args"].metrics_dir:
+        do_progress_metrics(progress, None if not final else progress.get("retcode"))
+
+
+def do_progress_metrics(progress, retcode=None):
+    # node-exporter textfile collector格式，先写临时文件再rename保证原子
+    args = progress["args"]
+    rate, total, ratio, eta = check_progress_stats(progress)
+    labels = f'workdir="{args.workdir}",arch="{args.arch}",phase="{progress["phase"]}"'
+    metrics = [
+        ("kdev_build_running", "gauge", "1 if the build phase is running", 1 if retcode is None else 0),
+        ("kdev_build_start_time_seconds", "gauge", "unix time the build phase started", progress["start_time"]),
+        ("kdev_build_objects_done", "gauge", "objects built (CC/LD/AR lines)", progress["done"]),
+        ("kdev_build_objects_total", "gauge", "estimated objects to build, -1 if unknown", total or -1),
+        ("kdev_build_progress_ratio", "gauge", "done/total, -1 if unknown", -1 if ratio is None else ratio),
+        ("kdev_build_objects_per_second", "gauge", "objects built per second", rate),
+        ("kdev_build_eta_seconds", "gauge", "estimated seconds left, -1 if unknown", -1 if eta is None else eta),
+    ]
+    if retcode is not None:
+        metrics.append(("kdev_build_last_retcode", "gauge", "retcode of the finished build phase", retcode))
+    text = ""
+    for name, kind, help_text, value in metrics:
+        text += f"# HELP {name} {help_text}\n# TYPE {name} {kind}\n{name}{{{labels}}} {round(value, 3)}\n"
+    os.makedirs(args.metrics_dir, exist_ok=True)
+    name = "kdev_" + hashlib.sha1(args.workdir.encode()).hexdigest()[:12] + ".prom"
+    path = os.path.join(args.metrics_dir, name)
+    tmpfile = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmpfile, "w") as f:
+            f.write(text)
+        os.replace(tmpfile, path)
+    except OSError as e:
+        pdebug(f"write metrics {path} failed: {e}")
+
+
+def do_kernel_phase(args, phase, cmd, logfile, prefix="", tail_lines=50, progress=None):
+    result = {"name": phase, "retcode": 0, "wall": 0.0, "user": 0.0, "sys": 0.0, "maxrss_kb": 0}
+    marker = {}
+    tail = collections.deque(maxlen=tail_lines)
+
+    def make_callback(tag):
+        def callback(line):
+            line = line.strip()
+            if not line:
+                return
+            # 脚本退出时输出的资源统计，不写入日志
+            if line.startswith("KDEV_RUSAGE "):
+                marker["rusage"] = line.split()[1:]
+                return
+            tail.append(line)
+            if not args.quiet:
+                print(prefix + tag, line, flush=True)
+            do_log_write(log_state, tag, line)
+            if progress is not None:
+                do_progress_line(progress, line)
+        return callback
+
+    pdebug("Run phase cmd:" + " ".join(cmd))
+    start = time.monotonic()
+    log_state = do_log_open(logfile)
+    with do_trace_span(f"phase {phase}", "phase", log=logfile) as span:
+        try:
+            ret, _, _, rusage = do_run_cmd(cmd, on_stdout=make_callback("STDOUT"),
+                                           on_stderr=make_callback("STDERR"), tail_lines=1)
+        finally:
+            log_index = do_log_close(log_state)
+        span["retcode"] = ret
+    result["retcode"] = ret
+    result["wall"] = round(time.monotonic() - start, 3)
+    if "rusage" in marker and len(marker["rusage"]) == 3:
+        # 使用脚本输出的make进程树统计，wait4的峰值包含fork时继承的kdev进程内存，
+        # docker编译时docker客户端统计也无意义
+        user, system, peak = marker["rusage"]
+        result["user"] = check_bash_times(user)
+        result["sys"] = check_bash_times(system)
+        result["maxrss_kb"] = int(peak) if peak.isdigit() else 0
+    elif args.nodocker:
+        result["user"] = round(rusage.ru_utime, 3)
+        result["sys"] = round(rusage.ru_stime, 3)
+        result["maxrss_kb"] = rusage.ru_maxrss
+    result["log"] = logfile
+    if progress is not None:
+        result["objects"] = progress["done"]
+        progress["retcode"] = ret
+        do_progress_show(progress, final=True)
+    return result, list(tail), log_index
+
+
+def do_print_phase(result):
+    print(f" phase {result['name']} retcode={result['retcode']} wall={result['wall']}s "
+          f"cpu={result['user'] + result['sys']:.2f}s maxrss={result['maxrss_kb']}KB")
+
+
+def check_bash_times(value):
+    # bash times输出格式: 1m2.345s，python统计输出秒数
+    if re.match(r'^[\d.]+$', value):
+        return round(float(value), 3)
+    match = re.match(r'(\d+)m([\d.]+)s', value)
+    if not match:
+        return 0.0
+    return round(int(match.group(1)) * 60 + float(match.group(2)), 3)
+
+
+def check_kernel_release(args):
+    release_file = os.path.join(args.workdir, "build", "include", "config", "kernel.release")
+    if not os.path.isfile(release_file):
+        return None
+    with open(release_file, "r") as f:
+        return f.read().strip()
+
+
+def check_kernel_image(args):
+    if args.arch == "x86_64":
+        image = os.path.join(args.workdir, "build", "arch", "x86", "boot", "bzImage")
+    else:
+        image = os.path.join(args.workdir, "build", "arch", args.arch, "boot", "Image")
+    if not os.path.isfile(image):
+        return None
+    return image
+
+
+def check_static_binary(path):
+    # ldd对静态程序返回非0
+    retcode, output, error = do_exe_cmd(["ldd", path])
+    return retcode != 0 or "not a dynamic executable" in output + error
+
+
+def check_module_deps(moddir, names):
+    # 根据modules.dep按依赖顺序返回需要加载的模块，内置模块跳过
+    builtin = set()
+    if os.path.isfile(os.path.join(moddir, "modules.builtin")):
+        with open(os.path.join(moddir, "modules.builtin"), "r") as f:
+            for line in f:
+                builtin.add(re.sub(r'\.ko$', '', os.path.basename(line.strip())).replace('-', '_'))
+    deps = {}
+    paths = {}
+    with open(os.path.join(moddir, "modules.dep"), "r") as f:
+        for line in f:
+            if ':' not in line:
+                continue
+            path, dep = line.split(':', 1)
+            name = re.sub(r'\.ko(\.\w+)?$', '', os.path.basename(path)).replace('-', '_')
+            paths[name] = path
+            deps[path] = dep.split()
+    ordered = []
+
+    def visit(path):
+        if path in ordered:
+            return
+        for dep in deps.get(path, []):
+            visit(dep)
+        ordered.append(path)
+
+    for name in names:
+        if name in paths:
+            visit(paths[name])
+        elif name not in builtin:
+            pwarn(f"module {name} not found in {moddir}")
+    return ordered
+
+
+def do_read_module(path):
+    # busybox insmod不支持压缩模块，打包时解压
+    if path.endswith(".xz"):
+        with lzma.open(path, "rb") as f:
+            return f.read()
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    if path.endswith(".zst"):
+        result = subprocess.run(["zstd", "-dc", path], stdout=subprocess.PIPE, check=True)
+        return result.stdout
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def do_write_cpio(path, entries):
+    # 生成gzip压缩的newc格式cpio，entries: (name, mode, data)，目录data为None，软链接data为目标路径
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        for ino, (name, mode, data) in enumerate(entries + [("TRAILER!!!", 0, b'')], start=1):
+            if data is None:
+                data = b''
+            elif isinstance(data, str):
+                data = data.encode("utf-8")
+            namebytes = name.encode("utf-8") + b'\0'
+            nlink = 2 if stat.S_ISDIR(mode) else 1
+            header = "070701" + "".join("%08X" % v for v in [
+                ino, mode, 0, 0, nlink, 0, len(data), 0, 0, 0, 0, len(namebytes), 0])
+            f.write(header.encode("ascii") + namebytes)
+            f.write(b'\0' * ((4 - (110 + len(namebytes)) % 4) % 4))
+            f.write(data)
+            f.write(b'\0' * ((4 - len(data) % 4) % 4))
+
+
+@do_trace_func("copy")
+def do_build_direct_initramfs(args, release, initrd):
+    # 最小initramfs: busybox + 挂载根分区及9p模块共享所需的驱动
+    busybox = args.busybox or shutil.which("busybox")
+    if not busybox or not os.path.isfile(busybox):
+        perror("busybox not found! install busybox-static or set --busybox")
+    if not check_static_binary(busybox):
+        perror(f"{busybox} is not static linked! install busybox-static or set --busybox")
+    moddir = os.path.join(args.workdir, "lib", "modules", release)
+    modules = []
+    if os.path.isfile(os.path.join(moddir, "modules.dep")):
+        modules = check_module_deps(moddir, DIRECT_BOOT_MODULES)
+
+    entries = []
+    for d in ["bin", "dev", "proc", "sys", "newroot", "lib", "lib/modules", f"lib/modules/{release}"]:
+        entries.append((d, stat.S_IFDIR | 0o755, None))
+    with open(busybox, "rb") as f:
+        entries.append(("bin/busybox", stat.S_IFREG | 0o755, f.read()))
+    entries.append(("bin/sh", stat.S_IFLNK | 0o777, "busybox"))
+    insmod = []
+    for module in modules:
+        name = re.sub(r'\.(xz|gz|zst)$', '', module)
+        for i in range(1, name.count('/') + 1):
+            d = f"lib/modules/{release}/" + "/".join(name.split('/')[:i])
+            if (d, stat.S_IFDIR | 0o755, None) not in entries:
+                entries.append((d, stat.S_IFDIR | 0o755, None))
+        entries.append((f"lib/modules/{release}/{name}", stat.S_IFREG | 0o644,
+                        do_read_module(os.path.join(moddir, module))))
+        insmod.append(f"insmod /lib/modules/{release}/{name}")
+    init = """#!/bin/busybox sh
+/bin/busybox --install -s /bin
+mount -t proc proc /proc
+mount -t sysfs sysfs /sys
+mount -t devtmpfs devtmpfs /dev
+%s
+ROOT=/dev/vda1
+for x in $(cat /proc/cmdline); do
+    case $x in
+        root=*) ROOT=${x#root=} ;;
+    esac
+done
+for i in $(seq 1 100); do
+    [ -b ${ROOT} ] && break
+    sleep 0.1
+done
+if ! mount -o rw ${ROOT} /newroot; then
+    echo "kdev: mount ${ROOT} failed!"
+    exec sh
+fi
+# 模块通过9p共享workdir/lib/modules，无需写入镜像
+mount -t 9p -o trans=virtio,version=9p2000.L,ro kdevmods /newroot/lib/modules || echo "kdev: mount kdevmods failed!"
+umount /proc /sys
+mount --move /dev /newroot/dev
+exec switch_root /newroot /sbin/init
+""" % "\n".join(f"{cmd} 2>/dev/null" for cmd in insmod)
+    entries.append(("init", stat.S_IFREG | 0o755, init))
+    do_write_cpio(initrd, entries)
+    print(f" build initramfs {initrd} with {len(modules)} modules")
+
+
+def do_direct_qemu_cmd(args, kernel, initrd, append=""):
+    kvm = os.path.exists("/dev/kvm") and os.uname().machine == args.vmarch
+    if args.arch == "x86_64":
+        cmd = ["qemu-system-x86_64", "-machine", "q35,accel=kvm:tcg"]
+        console = "ttyS0"
+    else:
+        cmd = ["qemu-system-aarch64", "-machine", "virt,accel=kvm:tcg"]
+        console = "ttyAMA0"
+    cmd += ["-cpu", "host" if kvm else "max",
+            "-smp", str(args.vmcpu),
+            "-m", str(args.vmram),
+            "-kernel", kernel,
+            "-initrd", initrd,
+            "-append", f"root=/dev/vda1 rw console={console} {append}".strip(),
+            "-drive", f"file={args.overlay},if=virtio,format=qcow2",
+            "-virtfs", f"local,path={os.path.join(args.workdir, 'lib', 'modules')},mount_tag=kdevmods,"
+                       f"security_model=none,readonly=on",
+            "-netdev", "user,id=net0",
+            "-device", "virtio-net-pci,netdev=net0",
+            "-nographic"]
+    return cmd
+
+
+def check_overlay_backing(overlay):
+    # overlay记录的backing file绝对路径，相对路径按overlay所在目录解析
+    retcode, output, _ = do_exe_cmd(["qemu-img", "info", "-U", "--output=json", overlay])
+    if retcode != 0:
+        return None
+    try:
+        backing = json.loads(output).get("backing-filename")
+    except ValueError:
+        return None
+    if not backing:
+        return None
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(overlay)), backing))
+
+
+def do_prepare_overlay(args):
+    image_cache = getattr(args, "image_cache", None) or os.path.join(KDEV_CACHE_DIR, "images")
+    # 下载的镜像只读，作为overlay的backing file，不再直接修改
+    cached = os.path.abspath(do_download_image(args.qcow2_url, image_cache, threads=int(getattr(args, "download_threads", 4))))
+    qcow2 = os.path.join(args.workdir, args.qcow2)
+
+    if getattr(args, "fresh", None) and os.path.isfile(args.overlay):
+        os.remove(args.overlay)
+        print(f" remove old overlay {args.overlay}")
+    backing = check_overlay_backing(args.overlay) if os.path.isfile(args.overlay) else None
+    if backing == os.path.abspath(qcow2) and os.path.isfile(qcow2) and not os.path.samefile(qcow2, cached):
+        # 旧版本以workdir中的镜像为backing file，重新链接会使overlay落在不同的基础镜像上
+        perror(f"overlay {args.overlay} is based on {args.qcow2}, but upstream published a new image. "
+               f"Tips: run `kdev rootfs --fresh` to recreate the overlay")
+
+    if not os.path.isfile(qcow2) or not os.path.samefile(qcow2, cached):
+        do_link_image(cached, qcow2)
+    else:
+        print(f" already exists {args.qcow2}, reusing it.")
 
+    if not os.path.isfile(args.overlay):
+        # backing file使用按校验值区分的缓存镜像，上游更新镜像后已有overlay不受影响
+        retcode, _, error = do_exe_cmd(["qemu-img", "create", "-f", "qcow2", "-F", "qcow2",
+                                        "-b", cached, args.overlay],
+                                       print_output=True)
+        if retcode != 0:
+            perror(f"Create overlay {args.overlay} failed! {error}")
+        print(f" create overlay {args.overlay} backing {cached}")
+    else:
+        if backing and backing != os.path.abspath(qcow2) and backing != cached:
+            pwarn(f"overlay {args.overlay} is based on older image {backing}. "
+                  f"Tips: run `kdev rootfs --fresh` to use the new image")
+        print(f" already exists overlay {args.overlay}, reusing it.")
+
+
+def do_prepare_direct(args):
+    kernel = args.kernel or check_kernel_image(args)
+    if not kernel:
+        perror("no kernel image found! Tips: run `kdev kernel`")
+    release = check_kernel_release(args)
+    if not release:
+        perror("no kernel release found! Tips: run `kdev kernel`")
+    do_prepare_overlay(args)
+    initrd = os.path.join(args.workdir, f"kdev-direct-initramfs-{release}.img")
+    do_build_direct_initramfs(args, release, initrd)
+    return kernel, initrd
+
+
+def do_run_direct(args):
+    # 直接引导编译产物，模块通过9p共享，不修改镜像，无需二次重启
+    kernel, initrd = do_prepare_direct(args)
+    qemu_cmd = do_direct_qemu_cmd(args, kernel, initrd, args.append or "")
+    print("run qemu cmd:", " ".join(qemu_cmd))
+    print("Tips: press Ctrl-a x to exit qemu")
+    return subprocess.call(qemu_cmd)
+
+
+def do_boot_once(qemu_cmd, timeout):
+    # 串口输出可能不以换行结束(login:)，按原始数据块匹配里程碑
+    pending = list(BOOT_MILESTONES)
+    marks = {}
+    window = {"text": ""}
+    start = time.monotonic()
+
+    def on_chunk(chunk):
+        now = time.monotonic() - start
+        window["text"] = (window["text"] + chunk.decode("utf-8", errors="replace"))[-8192:]
+        while pending and re.search(pending[0][1], window["text"], re.M):
+            name, pattern = pending.pop(0)
+            marks[name] = round(now, 3)
+            # 后续里程碑只在本次命中之后的输出中匹配
+            window["text"] = window["text"][re.search(pattern, window["text"], re.M).end():]
+            pdebug(f"boot milestone {name} at {marks[name]}s")
+        return not pending
+
+    ret, _, _, _ = do_run_cmd(qemu_cmd, on_chunk=on_chunk, timeout=timeout, tail_lines=20,
+                              stdin=subprocess.DEVNULL)
+    marks["ok"] = not pending
+    if pending:
+        marks["retcode"] = ret
+        marks["missing"] = [name for name, _ in pending]
+    return marks
+
+
+def check_percentile(values, percent):
+    # nearest-rank百分位
+    values = sorted(values)
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def handle_bench_boot(args):
+    handle_check(args)
+    check_rootfs_image(args)
+    check_vm_args(args)
+    kernel, initrd = do_prepare_direct(args)
+    # -snapshot丢弃所有写入，每次启动的磁盘状态一致
+    qemu_cmd = do_direct_qemu_cmd(args, kernel, initrd, args.append or "") + ["-snapshot"]
+    print("bench qemu cmd:", " ".join(qemu_cmd))
+
+    runs = []
+    for i in range(int(args.runs)):
+        marks = do_boot_once(qemu_cmd, int(args.timeout))
+        marks["run"] = i + 1
+        runs.append(marks)
+        summary = " ".join(f"{name}={marks[name]}s" for name, _ in BOOT_MILESTONES if name in marks)
+        print(f" boot {i + 1}/{args.runs} {'ok' if marks['ok'] else 'failed'} {summary}")
+
+    result = {
+        "kdev": CURRENT_VERSION,
+        "start": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "kernel": kernel,
+        "kernelrelease": check_kernel_release(args),
+        "image": args.qcow2,
+        "arch": args.arch,
+        "vmcpu": args.vmcpu,
+        "vmram": args.vmram,
+        "runs": runs,
+        "stats": {},
+    }
+    for name, _ in BOOT_MILESTONES:
+        values = [r[name] for r in runs if name in r]
+        if values:
+            result["stats"][name] = {
+                "count": len(values),
+                "min": min(values),
+                "median": round(statistics.median(values), 3),
+                "p95": check_percentile(values, 95),
+            }
+    output = args.output or os.path.join(args.workdir, "kdev-bench-boot.json")
+    with open(output, "w") as f:
+        json.dump(result, f, indent=4)
 
-def do_clean_nbd():
-    for entry in os.listdir("/sys/block/"):
-        full_path = os.path.join("/sys/block/", entry)
-        if os.path.isdir(full_path) and os.path.basename(full_path).startswith("nbd"):
-            if os.path.exists(os.path.join(full_path, "pid")):
-                nbd_name = os.path.basename(full_path)
-                retcode, _, _ = do_exe_cmd(f"qemu-nbd -d /dev/{nbd_name}", print_output=True)
-                if 0 != retcode:
-                    print(f"umount {nbd_name} failed! retcode={retcode}")
-                else:
-                    print(f"umount {nbd_name} done!")
+    print(f" {'milestone':<10} {'count':>6} {'min':>8} {'median':>8} {'p95':>8}")
+    for name, stats in result["stats"].items():
+        print(f" {name:<10} {stats['count']:>6} {stats['min']:>8} {stats['median']:>8} {stats['p95']:>8}")
+    print(f" bench report : {output}")
+    failed = [r["run"] for r in runs if not r["ok"]]
+    if failed:
+        perror(f"boot {', '.join(map(str, failed))} did not reach login prompt")
+    print("handle bench boot done!")
+
+
+def do_chroot_cmd(mntdir, cmd):
+    return do_exe_cmd(["chroot", mntdir, "/bin/sh", "-c", cmd], print_output=True)
+
+
+@do_trace_func("chroot")
+def do_chroot_initramfs(args, mntdir, release):
+    # 在主机上chroot进镜像，只为本次编译的内核生成initramfs并设置默认启动项，首次开机无需再重启
+    binds = []
+    try:
+        for src, fstype in [("/proc", "proc"), ("/sys", "sysfs"), ("/dev", None)]:
+            dst = os.path.join(mntdir, src.lstrip("/"))
+            if fstype:
+                cmd = ["mount", "-t", fstype, fstype, dst]
+            else:
+                cmd = ["mount", "--bind", src, dst]
+            retcode, _, _ = do_exe_cmd(cmd, print_output=True)
+            if retcode != 0:
+                return False
+            binds.append(dst)
+
+        # 跨架构时依赖qemu-user-binfmt，不可用则回退到首次开机生成
+        retcode, _, _ = do_chroot_cmd(mntdir, "true")
+        if retcode != 0:
+            pwarn(f"chroot {mntdir} failed, fallback to generate initramfs on first boot")
+            return False
+
+        if os.path.isfile(os.path.join(mntdir, "boot", f"vmlinuz-{release}")):
+            retcode, _, _ = do_chroot_cmd(mntdir, f"""
+if which update-initramfs > /dev/null 2>&1 ; then
+    rm -f /boot/initrd.img-{release}
+    update-initramfs -c -k {release}
+elif which dracut > /dev/null 2>&1 ; then
+    dracut -f /boot/initramfs-{release}.img {release}
+else
+    echo "no initramfs tool found"
+    exit 1
+fi""")
+            if retcode != 0:
+                pwarn(f"generate initramfs for {release} failed")
+                return False
+            print(f" generate initramfs for {release} done!")
+
+            # grub菜单项id由根分区uuid决定，提前设置默认启动项，只需生成一次grub.cfg
+            _, uuid, _ = do_exe_cmd(["blkid", "-s", "UUID", "-o", "value", f"/dev/{args.nbd}p1"])
+            uuid = uuid.strip()
+            grubd = os.path.join(mntdir, "etc/default/grub.d")
+            if uuid and os.path.isdir(os.path.dirname(grubd)):
+                os.makedirs(grubd, exist_ok=True)
+                with open(os.path.join(grubd, "kdev.cfg"), "w") as f:
+                    f.write(f'GRUB_DEFAULT="gnulinux-advanced-{uuid}>gnulinux-{release}-advanced-{uuid}"\n')
+            retcode, _, _ = do_chroot_cmd(mntdir, """
+if which update-grub2 > /dev/null 2>&1 ; then
+    update-grub2
+elif which update-grub > /dev/null 2>&1 ; then
+    update-grub
+elif which grub2-mkconfig > /dev/null 2>&1 ; then
+    grub2-mkconfig -o /boot/grub2/grub.cfg
+fi""")
+            if retcode != 0:
+                pwarn("update grub failed")
+                return False
+
+        do_chroot_cmd(mntdir, """
+if which chpasswd > /dev/null 2>&1 ; then
+    echo root:linux | chpasswd
+fi
+if which ssh-keygen > /dev/null 2>&1 ; then
+    ssh-keygen -A
+fi""")
+        return True
+    finally:
+        for dst in reversed(binds):
+            do_exe_cmd(["umount", "-l", dst], print_output=True)
+
+
+def do_write_firstboot(mntdir, release):
+    with open(os.path.join(mntdir, "etc/firstboot"), "w") as f:
+        f.write("")
+    with open(os.path.join(mntdir, "etc/rc.local"), "w") as f:
+        f.write("""#!/bin/bash
+
+if [ -f /etc/firstboot ]; then
+	rm -f /etc/firstboot
+	cd /boot
+	for k in %s; do
+		KERNEL=${k//vmlinuz-/}
+		update-initramfs -k ${KERNEL} -c
+	done
+	if which update-grub2 &> /dev/null ; then
+	    update-grub2
+	fi
+	sync
+	if which chpasswd &> /dev/null ; then
+		echo root:linux | chpasswd
+	elif which passwd &> /dev/null ; then
+		echo linux | passwd -stdin root
+	else
+		echo "can't reset root passwd"
+	fi
+	if [ -d /etc/cloud/ ]; then
+		touch /etc/cloud/cloud-init.disabled
+		rm -f /usr/bin/cloud-*
+	fi
+	if which ssh-keygen &> /dev/null ; then
+	    ssh-keygen -A
+	fi
+	sync
+	reboot -f
+fi
+
+exit 0
+
+""" % (f"vmlinuz-{release}" if release else "$(ls vmlinuz-*)"))
+    os.chmod(os.path.join(mntdir, "etc/rc.local"), 0o755)
+    print(" set rc.local done!")
+
+
+@do_trace_func("sync")
+def do_syncfs(path):
+    # 只刷写目标文件系统，避免全局sync刷写整个主机的page cache
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syncfs(fd) != 0:
+            pwarn(f"syncfs {path} failed: {os.strerror(ctypes.get_errno())}, fallback to sync")
+            os.sync()
+    finally:
+        os.close(fd)
+
+
+@do_trace_func("copy")
+def do_inject_tree(srcroot, dstroot, subdirs):
+    # 清单记录上次注入的文件(大小/mtime/哈希)，保存在镜像内，overlay重建后自动全量注入
+    manifest_file = os.path.join(dstroot, "var/lib/kdev/inject.json")
+    try:
+        with open(manifest_file, "r") as f:
+            old = json.load(f)
+    except (OSError, ValueError):
+        old = {}
+    new = {}
+    copied, copied_bytes, skipped, removed = 0, 0, 0, 0
+
+    for subdir in subdirs:
+        srcdir = os.path.join(srcroot, subdir)
+        if not os.path.isdir(srcdir):
+            continue
+        for root, dirs, files in os.walk(srcdir):
+            relroot = os.path.relpath(root, srcroot)
+            os.makedirs(os.path.join(dstroot, relroot), exist_ok=True)
+            # os.walk不进入软链接目录，作为软链接处理
+            names = [d for d in dirs if os.path.islink(os.path.join(root, d))] + files
+            for name in names:
+                src = os.path.join(root, name)
+                rel = os.path.join(relroot, name)
+                dst = os.path.join(dstroot, rel)
+                st = os.lstat(src)
+                prev = old.get(rel)
+                if stat.S_ISLNK(st.st_mode):
+                    entry = ["link", os.readlink(src)]
+                    new[rel] = entry
+                    if prev == entry and os.path.islink(dst):
+                        skipped += 1
+                        continue
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    os.symlink(entry[1], dst)
+                    copied += 1
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                exists = os.path.isfile(dst) and not os.path.islink(dst)
+                if exists and prev and prev[0] == st.st_size and prev[1] == st.st_mtime_ns:
+                    new[rel] = prev
+                    skipped += 1
+                    continue
+                # mtime变化但内容相同(如重新modules_install)，不写入镜像
+                digest = do_hash_file(src, "sha1")
+                new[rel] = [st.st_size, st.st_mtime_ns, digest]
+                if exists and prev and prev[2] == digest:
+                    skipped += 1
+                    continue
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                shutil.copy2(src, dst)
+                copied += 1
+                copied_bytes += st.st_size
+
+    # 清理上次注入但本次已不存在的文件，以及已不存在的内核版本的模块目录
+    stale_releases = set()
+    for rel in old:
+        if rel in new:
+            continue
+        dst = os.path.join(dstroot, rel)
+        if os.path.lexists(dst) and not os.path.isdir(dst):
+            os.remove(dst)
+            removed += 1
+        parts = rel.split(os.sep)
+        if len(parts) > 3 and parts[0] == "lib" and parts[1] == "modules":
+            stale_releases.add(parts[2])
+    for release in stale_releases:
+        if os.path.isdir(os.path.join(srcroot, "lib/modules", release)):
+            continue
+        moddir = os.path.join(dstroot, "lib/modules", release)
+        if os.path.isdir(moddir):
+            shutil.rmtree(moddir)
+            print(f" remove stale modules {moddir}")
+
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file, "w") as f:
+        json.dump(new, f)
+    print(f" inject {dstroot} done! copied {copied} files ({copied_bytes // 1024 // 1024}MB), "
+          f"unchanged {skipped}, removed {removed}")
 
 
 def perror(str):
@@ -336,6 +2021,9 @@ def handle_init(args):
               "sysstat " \
               "python3-pip " \
               "curl " \
+              "ccache " \
+              "rsync " \
+              "busybox-static " \
               "docker-ce"
     ret, _, stderr = do_exe_cmd(f"sudo apt-get install -y {deplist}", print_output=True)
     if ret != 0:
@@ -356,6 +2044,7 @@ def handle_check(args):
     else:
         args.sourcedir = os.getcwd()
         print(f"sourcedir is {args.sourcedir}")
+    args.sourcedir = os.path.abspath(args.sourcedir)
 
     if os.path.isfile(os.path.join(args.sourcedir, "Makefile")) and \
             os.path.isfile(os.path.join(args.sourcedir, "Kbuild")):
@@ -364,12 +2053,7 @@ def handle_check(args):
         print(f"Check {args.sourcedir} failed! It's not a kernel source directory.")
         sys.exit(1)
 
-    os.chdir(args.sourcedir)
-    ret, kernelversion, _ = do_exe_cmd("make kernelversion")
-    if ret != 0:
-        perror(f"Unsupported {kernelversion}")
-
-    args.kernelversion = kernelversion.strip()
+    args.kernelversion = check_kernel_version(args.sourcedir)
     print(f"kernel version : {args.kernelversion}")
 
     args.masterversion = args.kernelversion[0]
@@ -382,83 +2066,275 @@ def handle_check(args):
 
 def handle_kernel(args):
     handle_check(args)
+    check_src_hugefile(args)
     print(" -> Step build kernel")
-    os.chdir(args.workdir)
+    if args.deploy:
+        if args.matrix:
+            perror("--deploy can not be used with --matrix")
+        check_privilege()
+        check_rootfs_image(args)
+        # 产物不落在workdir，无法存入产物缓存
+        if args.artifact_cache:
+            pwarn("--artifact-cache is ignored with --deploy")
+        args.artifact_cache = None
+    if args.matrix:
+        do_build_matrix(args)
+        print("handle kernel done!")
+        return
 
+    report = do_build_kernel(args)
+    if report["retcode"] != 0:
+        perror(f"build phase {', '.join(report['failed'])} failed!")
+    print("build ok with 0 retcode")
+    print("handle kernel done!")
+
+
+def check_warm_container(args):
+    # 每个workdir一个常驻编译容器，挂载参数变化时需要重建
+    name = "kdev-" + hashlib.sha1(args.workdir.encode()).hexdigest()[:12]
+    mounts = ["-v", f"{args.sourcedir}:/kernel", "-v", f"{args.workdir}:/workdir"]
+    if args.ccache:
+        mounts += ["-v", f"{args.ccache_dir}:/ccache"]
+    config = hashlib.sha1(" ".join([args.docker_image, str(args.warm_timeout)] + mounts).encode()).hexdigest()
+    return name, mounts, config
+
+
+def do_warm_container(args):
+    name, mounts, config = check_warm_container(args)
+    heartbeat = os.path.join(args.workdir, WARM_HEARTBEAT)
+    # 先更新心跳，避免容器在复用前刚好空闲超时退出
+    open(heartbeat, "a").close()
+    os.utime(heartbeat)
+    retcode, output, _ = do_exe_cmd(["docker", "inspect", "-f",
+                                     '{{.State.Running}} {{index .Config.Labels "kdev.config"}}', name])
+    if retcode == 0:
+        if output.split() == ["true", config]:
+            print(f" reuse warm container : {name}")
+            return name
+        print(f" warm container {name} config changed, recreate it")
+        do_exe_cmd(["docker", "rm", "-f", name])
+
+    # 容器内看门狗：有编译进程时刷新心跳，心跳超时后退出，--rm自动删除容器
+    watchdog = f"""
+while true; do
+    sleep 10
+    if grep -qsa 'build_in_docker[.]sh' /proc/[0-9]*/cmdline; then
+        touch /workdir/{WARM_HEARTBEAT}
+        continue
+    fi
+    last=$(stat -c %Y /workdir/{WARM_HEARTBEAT} 2>/dev/null || echo 0)
+    if [ $(( $(date +%s) - last )) -ge {args.warm_timeout} ]; then
+        echo "idle for {args.warm_timeout}s, exit"
+        exit 0
+    fi
+done
+"""
+    cmd = ["docker", "run", "-d", "--rm", "--init",
+           "--name", name,
+           "--label", "kdev.warm=1",
+           "--label", f"kdev.workdir={args.workdir}",
+           "--label", f"kdev.config={config}"] + mounts + \
+          ["-w", "/workdir", args.docker_image, "/bin/bash", "-c", watchdog]
+    retcode, _, error = do_exe_cmd(cmd)
+    if retcode != 0:
+        perror(f"start warm container {name} failed! {error}")
+    print(f" start warm container : {name} (idle timeout {args.warm_timeout}s)")
+    return name
+
+
+def do_clean_warm_containers():
+    retcode, output, _ = do_exe_cmd(["docker", "ps", "-aq", "--filter", "label=kdev.warm=1"])
+    if retcode != 0 or not output.split():
+        return
+    do_exe_cmd(["docker", "rm", "-f"] + output.split(), print_output=True)
+
+
+def do_build_kernel(args):
+    # 不切换工作目录，矩阵编译时多个目标在线程中并发执行
+    os.makedirs(args.workdir, exist_ok=True)
     if args.config:
         print(f" set kenrel config from cmdline {args.config}")
         kernel_config = args.config
     else:
         kernel_config = f"debian_{args.arch}_defconfig"
+    args.kernel_config = kernel_config
+
+    args.cross_compile = ''
+    if os.uname().machine != args.arch:
+        if args.arch == "arm64":
+            args.cross_compile = "aarch64-linux-gnu-"
+    if not args.nodocker:
+        ok, image = check_docker_image(args)
+        if not ok:
+            perror("not useable docker image found!")
+        args.docker_image = image
+
+    if args.ccache:
+        if not args.ccache_dir:
+            args.ccache_dir = os.path.join(KDEV_CACHE_DIR, "ccache")
+        os.makedirs(args.ccache_dir, exist_ok=True)
+        print(f" ccache dir : {args.ccache_dir} (max size {args.ccache_size})")
+
+    # 未指定-j时根据cgroup配额、可用内存及历史报告中的单job内存自动计算
+    if args.job in [None, "auto"]:
+        args.job = check_auto_job(args, "build")
+        args.mod_job = check_auto_job(args, "modules_install")
+    else:
+        args.job = int(args.job)
+        args.mod_job = args.job
+
+    # tmpfs需在判断编译模式前挂载，空的tmpfs会触发全量编译(或从快照恢复)
+    args.build_tmpfs = bool(args.tmpfs) and do_mount_build_tmpfs(args)
+
+    # 模块压缩通过scripts/config修改.config，属于配置的一部分
+    args.module_compress_algo, args.module_compress_opts = check_module_compress(args)
+    if args.module_compress_algo:
+        print(f" module compress : {args.module_compress_algo}")
+
+    # 增量编译，根据指纹决定是否需要mrproper/defconfig
+    fingerprint = do_build_fingerprint(args, kernel_config)
+    args.build_mode = check_build_mode(args, fingerprint)
+    print(f" build mode : {args.build_mode}")
+    if args.build_mode != "incremental":
+        # 编译失败时不能留下旧指纹，否则下次会跳过defconfig
+        fingerprint_file = os.path.join(args.workdir, "build.fingerprint")
+        if os.path.isfile(fingerprint_file):
+            os.remove(fingerprint_file)
 
     # 生产编译脚本，因为不同环境对python版本有依赖要求，暂时不考虑规避，脚本万能
+    # 脚本按阶段执行: build_in_xxx.sh <phase>，由kdev逐个阶段调用并计时
     body = """
     
 ## body
 
-echo "run body"
-
 cd ${SOURCEDIR}
 
 mkdir -p ${WORKDIR}/build || :
-make O=${WORKDIR}/build mrproper
-make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} """ + kernel_config + """
-
-if [ $? -ne 0 ]; then
-    echo "make  """ + kernel_config + """ failed!"
-    exit 1
-fi
-ls -alh ${WORKDIR}/build/.config
-make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} -j "${JOB}"
-if [ $? -ne 0 ]; then
-    echo "Build kernel binary failed!"
-    exit 1
+# 安装阶段的第二个参数为安装根目录(直接部署到挂载的镜像)，默认为workdir
+INSTALL_ROOT=${2:-${WORKDIR}}
+KMAKE=(make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE})
+if [ "${USE_CCACHE}" == "1" ]; then
+    if which ccache &> /dev/null ; then
+        export CCACHE_DIR CCACHE_BASEDIR=${SOURCEDIR} CCACHE_NOHASHDIR=1
+        KMAKE+=(CC="ccache ${CROSS_COMPILE}gcc" HOSTCC="ccache gcc")
+    else
+        echo "ccache not found, build without ccache"
+        USE_CCACHE=0
+    fi
 fi
 
-echo " kernel install to ${WORKDIR}/boot"
-if [ ! -d "${WORKDIR}/boot" ]; then
-    mkdir -p ${WORKDIR}/boot
-fi
-make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} install INSTALL_PATH=${WORKDIR}/boot
-if [ $? -ne 0 ]; then
-    echo "make install to ${WORKDIR}/boot failed!"
-    exit 1
-fi
+# 阶段结束时输出make进程树的CPU时间及内存峰值(KB)，供kdev统计
+# 脚本由kdev fork而来，自身峰值含kdev进程内存，只统计已回收子进程的RUSAGE_CHILDREN
+kdev_rusage() {
+    local rc=$?
+    if which python3 &> /dev/null ; then
+        # exec不改变进程，子进程统计保留，退出码由python返回
+        exec python3 -c "import resource, sys; r = resource.getrusage(resource.RUSAGE_CHILDREN); \\
+print('KDEV_RUSAGE %.3f %.3f %d' % (r.ru_utime, r.ru_stime, r.ru_maxrss)); sys.exit(int(sys.argv[1]))" ${rc}
+    fi
+    # 没有python3时使用cgroup内存峰值扣除页缓存，常驻容器为容器启动以来的峰值，仅作为上限参考
+    local t=( $(times) )
+    local peak=0
+    if [ -f /sys/fs/cgroup/memory.peak ]; then
+        peak=$(( $(cat /sys/fs/cgroup/memory.peak) - $(awk '$1 == "file" {print $2}' /sys/fs/cgroup/memory.stat) ))
+    elif [ -f /sys/fs/cgroup/memory/memory.max_usage_in_bytes ]; then
+        peak=$(( $(cat /sys/fs/cgroup/memory/memory.max_usage_in_bytes) - $(awk '$1 == "cache" {print $2}' /sys/fs/cgroup/memory/memory.stat) ))
+    fi
+    echo "KDEV_RUSAGE ${t[2]} ${t[3]} $(( peak > 0 ? peak / 1024 : 0 ))"
+}
+trap kdev_rusage EXIT
 
-echo " kernel modules install to ${WORKDIR}"
-make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} INSTALL_MOD_STRIP=1 modules_install -j ${JOB} INSTALL_MOD_PATH=${WORKDIR}
-if [ $? -ne 0 ]; then
-    # try again
-    make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} INSTALL_MOD_STRIP=1 modules_install -j ${JOB} INSTALL_MOD_PATH=${WORKDIR}
+phase_defconfig() {
+    if [ "${BUILD_MODE}" == "full" ]; then
+        make O=${WORKDIR}/build mrproper
+    fi
+    "${KMAKE[@]}" """ + kernel_config + """
     if [ $? -ne 0 ]; then
-        echo "make modules_install to ${WORKDIR} failed!"
+        echo "make  """ + kernel_config + """ failed!"
         exit 1
     fi
-fi
+    if [ -n "${MODULE_COMPRESS_OPTS}" ]; then
+        ./scripts/config --file ${WORKDIR}/build/.config ${MODULE_COMPRESS_OPTS}
+        "${KMAKE[@]}" olddefconfig
+        if [ $? -ne 0 ]; then
+            echo "set module compress failed!"
+            exit 1
+        fi
+    fi
+    ls -alh ${WORKDIR}/build/.config
+}
 
-cd ${SOURCEDIR}
-KERNELRELEASE=$( make -s --no-print-directory O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} kernelrelease 2>/dev/null )
-KERNEL_HEADER_INSTALL=${WORKDIR}/usr/src/linux-headers-${KERNELRELEASE}
-echo " kernel headers install to ${KERNEL_HEADER_INSTALL}"
-if [ ! -d "${KERNEL_HEADER_INSTALL}" ]; then
-    mkdir -p ${KERNEL_HEADER_INSTALL}
-fi
-make O=${WORKDIR}/build ARCH=${ARCH} CROSS_COMPILE=${CROSS_COMPILE} headers_install INSTALL_HDR_PATH=${KERNEL_HEADER_INSTALL}
-if [ $? -ne 0 ]; then
-    echo "make headers_install to ${WORKDIR} failed!"
-    exit 1
-fi
+phase_build() {
+    if [ "${USE_CCACHE}" == "1" ]; then
+        ccache -M ${CCACHE_SIZE}
+        ccache -z
+    fi
+    "${KMAKE[@]}" -j "${JOB}"
+    if [ $? -ne 0 ]; then
+        echo "Build kernel binary failed!"
+        exit 1
+    fi
+    if [ "${USE_CCACHE}" == "1" ]; then
+        echo " ccache statistics"
+        ccache -s
+    fi
+}
+
+phase_install() {
+    echo " kernel install to ${INSTALL_ROOT}/boot"
+    if [ ! -d "${INSTALL_ROOT}/boot" ]; then
+        mkdir -p ${INSTALL_ROOT}/boot
+    fi
+    "${KMAKE[@]}" install INSTALL_PATH=${INSTALL_ROOT}/boot
+    if [ $? -ne 0 ]; then
+        echo "make install to ${INSTALL_ROOT}/boot failed!"
+        exit 1
+    fi
+}
+
+phase_modules_install() {
+    echo " kernel modules install to ${INSTALL_ROOT}"
+    "${KMAKE[@]}" INSTALL_MOD_STRIP=1 modules_install -j ${MOD_JOB} INSTALL_MOD_PATH=${INSTALL_ROOT}
+    if [ $? -ne 0 ]; then
+        # try again
+        "${KMAKE[@]}" INSTALL_MOD_STRIP=1 modules_install -j ${MOD_JOB} INSTALL_MOD_PATH=${INSTALL_ROOT}
+        if [ $? -ne 0 ]; then
+            echo "make modules_install to ${INSTALL_ROOT} failed!"
+            exit 1
+        fi
+    fi
+}
+
+phase_headers_install() {
+    KERNELRELEASE=$( "${KMAKE[@]}" -s --no-print-directory kernelrelease 2>/dev/null )
+    KERNEL_HEADER_INSTALL=${INSTALL_ROOT}/usr/src/linux-headers-${KERNELRELEASE}
+    echo " kernel headers install to ${KERNEL_HEADER_INSTALL}"
+    if [ ! -d "${KERNEL_HEADER_INSTALL}" ]; then
+        mkdir -p ${KERNEL_HEADER_INSTALL}
+    fi
+    "${KMAKE[@]}" headers_install INSTALL_HDR_PATH=${KERNEL_HEADER_INSTALL}
+    if [ $? -ne 0 ]; then
+        echo "make headers_install to ${INSTALL_ROOT} failed!"
+        exit 1
+    fi
+}
+
+case "$1" in
+    defconfig|build|install|modules_install|headers_install)
+        echo "run phase $1"
+        phase_$1
+        ;;
+    *)
+        echo "unknown phase $1"
+        exit 1
+        ;;
+esac
 
 """
 
     if args.nodocker:
         print("build kernel in host")
 
-        args.cross_compile = ''
-        if os.uname().machine != args.arch:
-            if args.arch == "arm64":
-                args.cross_compile = "aarch64-linux-gnu-"
-
         head = """
 #!/bin/bash
 
@@ -473,6 +2349,12 @@ ARCH=%s
 CROSS_COMPILE=%s
 KERNEL_HEADER_INSTALL=%s
 JOB=%s
+MOD_JOB=%s
+BUILD_MODE=%s
+MODULE_COMPRESS_OPTS="%s"
+USE_CCACHE=%s
+CCACHE_DIR=%s
+CCACHE_SIZE=%s
 """ % (
             args.workdir,
             args.sourcedir,
@@ -480,34 +2362,24 @@ JOB=%s
             args.cross_compile,
             args.kernelversion,
             args.job,
-
+            args.mod_job,
+            args.build_mode,
+            args.module_compress_opts,
+            "1" if args.ccache else "0",
+            args.ccache_dir,
+            args.ccache_size,
         )
-        with open("build_in_host.sh", "w") as script:
+        script_path = os.path.join(args.workdir, "build_in_host.sh")
+        with open(script_path, "w") as script:
             script.write(head + body)
 
-        os.chmod("build_in_host.sh", 0o755)
-        host_cmd = "/bin/bash build_in_host.sh"
-        print("run host build cmd:", host_cmd)
-        ret, output, error = do_exe_cmd(host_cmd,
-                                        print_output=True,
-                                        enable_log=True,
-                                        logfile="build_kernel_in_host.log")
-        if ret != 0:
-            perror("host build failed!")
-        print("host build ok with 0 retcode")
+        os.chmod(script_path, 0o755)
+        script_cmd = ["/bin/bash", script_path]
+        print("run host build cmd:", " ".join(script_cmd))
 
     else:
         print("build kernel in docker")
-        ok, image = check_docker_image(args)
-        if not ok:
-            perror("not useable docker image found!")
-        print(f" using docker image : {image} ")
-        args.docker_image = image
-
-        args.cross_compile = ''
-        if os.uname().machine != args.arch:
-            if args.arch == "arm64":
-                args.cross_compile = "aarch64-linux-gnu-"
+        print(f" using docker image : {args.docker_image} ")
 
         head = """#!/bin/bash
 set -x
@@ -523,139 +2395,806 @@ ARCH=%s
 CROSS_COMPILE=%s
 KERNEL_HEADER_INSTALL=%s
 JOB=%s
+MOD_JOB=%s
+BUILD_MODE=%s
+MODULE_COMPRESS_OPTS="%s"
+USE_CCACHE=%s
+CCACHE_DIR=%s
+CCACHE_SIZE=%s
 
 """ % (
-            "/work",
+            "/workdir",
             "/kernel",
             args.arch,
             args.cross_compile,
             args.kernelversion,
             args.job,
+            args.mod_job,
+            args.build_mode,
+            args.module_compress_opts,
+            "1" if args.ccache else "0",
+            "/ccache",
+            args.ccache_size,
         )
-        with open("build_in_docker.sh", "w") as script:
+        script_path = os.path.join(args.workdir, "build_in_docker.sh")
+        with open(script_path, "w") as script:
             script.write(head + body)
-        os.chmod("build_in_docker.sh", 0o755)
-        docker_cmd = f"docker run -t  " \
-                     f" -v {args.workdir}/build_in_docker.sh:/bin/kdev   " \
-                     f" -v {args.sourcedir}:/kernel   " \
-                     f" -v {args.workdir}:/workdir   " \
-                     f" -w /workdir   " \
-                     f"{args.docker_image}  " \
-                     f"/bin/kdev"
-        print("run docker build cmd:", docker_cmd)
-        ret, output, error = do_exe_cmd(docker_cmd,
-                                        print_output=True,
-                                        shell=False,
-                                        enable_log=True,
-                                        logfile="build_kernel_in_docker.log")
-        if ret != 0:
-            perror(f"docker build failed! retcode={ret}")
+        os.chmod(script_path, 0o755)
+        if args.warm:
+            # 常驻容器，脚本位于挂载的workdir中，每个阶段docker exec执行
+            container = do_warm_container(args)
+            script_cmd = ["docker", "exec", "-t", "-w", "/workdir", container,
+                          "/workdir/build_in_docker.sh"]
+        else:
+            # ccache目录挂载进容器，容器间和主机编译共享
+            ccache_mount = ["-v", f"{args.ccache_dir}:/ccache"] if args.ccache else []
+            script_cmd = ["docker", "run", "-t", "--rm",
+                          "-v", f"{script_path}:/bin/kdev",
+                          "-v", f"{args.sourcedir}:/kernel",
+                          "-v", f"{args.workdir}:/workdir"] + ccache_mount + \
+                         ["-w", "/workdir",
+                          args.docker_image,
+                          "/bin/kdev"]
+        print("run docker build cmd:", " ".join(script_cmd))
+
+    phases = ["build"]
+    if args.build_mode != "incremental":
+        phases.insert(0, "defconfig")
+    else:
+        print(f" skip {kernel_config}, reuse {args.workdir}/build/.config")
+
+    report = {
+        "kdev": CURRENT_VERSION,
+        "start": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "kernelversion": args.kernelversion,
+        "arch": args.arch,
+        "config": kernel_config,
+        "job": args.job,
+        "modules_install_job": args.mod_job,
+        "docker_image": None if args.nodocker else args.docker_image,
+        "build_mode": args.build_mode,
+        "incremental": args.build_mode == "incremental",
+        "ccache": bool(args.ccache),
+        "warm": bool(args.warm) and not args.nodocker,
+        "tmpfs": args.build_tmpfs,
+        "phases": [],
+    }
+    logdir = do_log_dir(args)
+    report["log_dir"] = logdir
+    print(f" build log dir : {logdir}")
+    log_indexes = []
+    start = time.monotonic()
+    failed = []
+    artifact_key = None
+    restored = False
+    for phase in phases:
+        # .config确定后才能计算缓存key，命中则跳过编译及安装
+        if phase == "build" and args.artifact_cache:
+            if not args.artifact_cache_dir:
+                args.artifact_cache_dir = os.path.join(KDEV_CACHE_DIR, "artifacts")
+            artifact_key = check_artifact_key(args)
+            if artifact_key and do_artifact_restore(args, artifact_key):
+                restored = True
+                break
+        print(f" -> phase {phase}")
+        progress = None
+        if phase == "build":
+            progress = do_progress_new(args, phase, check_progress_total(args))
+        result, tail, log_index = do_kernel_phase(args, phase, script_cmd + [phase],
+                                                  os.path.join(logdir, f"{phase}.log.gz"), progress=progress)
+        report["phases"].append(result)
+        log_indexes.append(dict(log_index, name=phase, retcode=result["retcode"]))
+        do_print_phase(result)
+        if result["retcode"] != 0:
+            failed.append((phase, tail, log_indexes[-1]))
+            break
+        # defconfig成功后.config与指纹一致，即使后续编译失败也可增量继续
+        if phase == "defconfig":
+            do_save_build_fingerprint(args, fingerprint)
+
+    # 安装阶段追加安装根目录参数，部署模式下为挂载的镜像
+    install_cmd = script_cmd
+    install_root = []
+    if args.deploy and not failed:
+        # 编译完成后才连接挂载镜像，避免长时间占用nbd
+        do_rootfs_mount(args)
+        args.deploy_dir = args.tmpdir
+        report["deploy"] = args.overlay
+        print(f" deploy to {args.overlay} mounted at {args.deploy_dir}")
+        if args.nodocker:
+            install_root = [args.deploy_dir]
+        else:
+            # 常驻容器无法追加挂载，安装阶段使用docker run挂载镜像挂载点
+            ccache_mount = ["-v", f"{args.ccache_dir}:/ccache"] if args.ccache else []
+            install_cmd = ["docker", "run", "-t", "--rm",
+                           "-v", f"{script_path}:/bin/kdev",
+                           "-v", f"{args.sourcedir}:/kernel",
+                           "-v", f"{args.workdir}:/workdir",
+                           "-v", f"{args.deploy_dir}:/install"] + ccache_mount + \
+                          ["-w", "/workdir", args.docker_image, "/bin/kdev"]
+            install_root = ["/install"]
+
+    # install/modules_install/headers_install只读编译产物且写入不同目录，并行执行
+    if not failed and not restored:
+        install_phases = ["install", "modules_install", "headers_install"]
+        print(f" -> phase {', '.join(install_phases)} (parallel)")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(install_phases)) as executor:
+            futures = {}
+            for phase in install_phases:
+                phase_cmd = install_cmd + [phase] + install_root
+                futures[phase] = executor.submit(do_kernel_phase, args, phase, phase_cmd,
+                                                 os.path.join(logdir, f"{phase}.log.gz"), f"[{phase}] ")
+            for phase in install_phases:
+                result, tail, log_index = futures[phase].result()
+                report["phases"].append(result)
+                log_indexes.append(dict(log_index, name=phase, retcode=result["retcode"]))
+                do_print_phase(result)
+                if result["retcode"] != 0:
+                    failed.append((phase, tail, log_indexes[-1]))
+    report["wall"] = round(time.monotonic() - start, 3)
+    report["retcode"] = 0
+    for result in report["phases"]:
+        if result["retcode"] != 0:
+            report["retcode"] = result["retcode"]
+            break
+    if args.deploy and getattr(args, "tmpdir", None):
+        if not failed:
+            do_rootfs_setup(args)
+        do_rootfs_umount(args)
+    if args.build_tmpfs:
+        build_dir = os.path.join(args.workdir, "build")
+        st = os.statvfs(build_dir)
+        report["build_tree_kb"] = (st.f_blocks - st.f_bfree) * st.f_frsize // 1024
+        if args.tmpfs_snapshot and not failed:
+            do_save_build_snapshot(args)
+    report["artifact_cache"] = {"key": artifact_key, "hit": restored}
+    if artifact_key and not failed and not restored:
+        # 打包写入的耗时及大小记入报告，便于评估缓存的代价
+        store_start = time.monotonic()
+        report["artifact_cache"]["store_mb"] = do_artifact_store(args, artifact_key) // 1024 // 1024
+        report["artifact_cache"]["store_wall"] = round(time.monotonic() - store_start, 3)
+        print(f" artifact cache store took {report['artifact_cache']['store_wall']}s")
+    report["module_compress"] = check_config_module_compress(args)
+    if args.module_compress_algo and report["module_compress"] != args.module_compress_algo:
+        pwarn(f"module compress {args.module_compress_algo} is not enabled in .config")
+    release_file = os.path.join(args.workdir, "build", "include", "config", "kernel.release")
+    if os.path.isfile(release_file):
+        with open(release_file, "r") as f:
+            report["kernelrelease"] = f.read().strip()
+    report["failed"] = [phase for phase, _, _ in failed]
+    report_file = os.path.join(args.workdir, "kdev-build-report.json")
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f" build report : {report_file}")
+    with open(os.path.join(logdir, "index.json"), "w") as f:
+        json.dump({"build": os.path.basename(logdir), "phases": log_indexes}, f)
+
+    if failed:
+        for phase, tail, log_index in failed:
+            print(f"build phase {phase} failed! log: {os.path.join(logdir, log_index['log'])}")
+            if log_index["first_error"] is None and log_index["failed_target"] is None:
+                print("\n".join(tail))
+            else:
+                do_print_log_errors(logdir, log_index)
+    return report
+
+
+def do_log_dir(args):
+    # 每次编译一个日志目录，logs/latest指向最近一次，只保留最近LOG_KEEP次
+    logroot = os.path.join(args.workdir, "logs")
+    os.makedirs(logroot, exist_ok=True)
+    name = time.strftime("%Y%m%d-%H%M%S") + ("-host" if args.nodocker else "-docker")
+    logdir = os.path.join(logroot, name)
+    count = 1
+    while os.path.exists(logdir):
+        count += 1
+        logdir = os.path.join(logroot, f"{name}.{count}")
+    os.makedirs(logdir)
+    latest = os.path.join(logroot, "latest")
+    tmplink = f"{latest}.{os.getpid()}"
+    os.symlink(os.path.basename(logdir), tmplink)
+    os.replace(tmplink, latest)
+    builds = sorted(d for d in os.listdir(logroot) if d != "latest" and os.path.isdir(os.path.join(logroot, d)))
+    for old in builds[:-LOG_KEEP]:
+        shutil.rmtree(os.path.join(logroot, old), ignore_errors=True)
+    return logdir
+
+
+def handle_log(args):
+    if not args.workdir:
+        args.workdir = os.getcwd()
+    logdir = os.path.join(args.workdir, "logs", args.build or "latest")
+    if not os.path.isdir(logdir):
+        perror(f"no build log found in {logdir}! Tips: run `kdev kernel`")
+    index_file = os.path.join(logdir, "index.json")
+    if os.path.isfile(index_file):
+        with open(index_file, "r") as f:
+            phases = json.load(f)["phases"]
+    else:
+        # 编译未正常结束，按阶段日志文件重建
+        phases = []
+        for phase in ["defconfig", "build", "install", "modules_install", "headers_install"]:
+            if os.path.isfile(os.path.join(logdir, f"{phase}.log.gz")):
+                phases.append({"name": phase, "log": f"{phase}.log.gz", "retcode": None,
+                               "checkpoints": [[0, 0]]})
+    if args.phase:
+        phases = [p for p in phases if p["name"] == args.phase]
+    print(f"build log : {os.path.realpath(logdir)}")
+    if args.errors and all(p.get("retcode") == 0 for p in phases):
+        print(" no failed phase found")
+    for index in phases:
+        path = os.path.join(logdir, index["log"])
+        if args.errors:
+            # 只看失败阶段，未完成的阶段retcode为None
+            if index.get("retcode") == 0 and not args.phase:
+                continue
+            print(f" -> phase {index['name']} retcode={index.get('retcode')}")
+            do_print_log_errors(logdir, index, int(args.context))
         else:
-            print("docker build ok with 0 retcode, exit docker.")
+            print(f" -> phase {index['name']}")
+            for line in do_log_iter(path):
+                print(line)
 
-    print("handle kernel done!")
 
+def check_size(value):
+    # 20G/512M/1024K转为字节数
+    match = re.match(r'^(\d+)([KMGT]?)B?$', str(value).strip().upper())
+    if not match:
+        perror(f"invalid size {value}")
+    return int(match.group(1)) * 1024 ** " KMGT".index(match.group(2) or " ")
 
-def handle_rootfs(args):
-    handle_check(args)
-    ok, image_url = check_qcow_image(args)
-    if not ok:
-        perror(" no available image found!")
-    print(f" using qcows url {image_url}")
 
-    args.qcow2_url = image_url
-    args.qcow2 = os.path.basename(image_url)
-    print(f" qcow2 name : {args.qcow2}")
-    os.chdir(args.workdir)
-    if not os.path.isfile(args.qcow2):
-        print(f" start to download {args.qcow2_url}")
-        retcode, _, _ = do_exe_cmd(["wget", "-c", args.qcow2_url],
-                                   print_output=True,
-                                   enable_log=True,
-                                   logfile="kdev-download.log"
-                                   )
-        if retcode != 0:
-            perror("Download qcow2 failed!")
+def check_artifact_key(args):
+    # 编译输入: 提交+未提交改动+最终.config+架构+工具链，任一变化都不复用
+    inputs = {"arch": args.arch, "cross_compile": args.cross_compile}
+    ret, output, _ = do_exe_cmd(["git", "-C", args.sourcedir, "rev-parse", "HEAD"])
+    if ret != 0:
+        pdebug(f"{args.sourcedir} is not a git repo, skip artifact cache")
+        return None
+    inputs["commit"] = output.strip()
+
+    diff = hashlib.sha256()
+    ret, _, _, _ = do_run_cmd(["git", "-C", args.sourcedir, "diff", "HEAD", "--binary"],
+                              on_chunk=diff.update, tail_lines=1)
+    if ret != 0:
+        return None
+    untracked = []
+    do_run_cmd(["git", "-c", "core.quotepath=off", "-C", args.sourcedir, "ls-files", "--others",
+                "--exclude-standard"], on_stdout=untracked.append, tail_lines=1)
+    for name in sorted(filter(None, untracked)):
+        diff.update(name.encode() + b'\0')
+        if os.path.isfile(os.path.join(args.sourcedir, name)):
+            diff.update(do_hash_file(os.path.join(args.sourcedir, name), "sha256").encode())
+    inputs["dirty"] = diff.hexdigest()
+    inputs["config"] = do_hash_file(os.path.join(args.workdir, "build", ".config"), "sha256")
+
+    if args.nodocker:
+        gcc = f"{args.cross_compile}gcc"
+        _, output, _ = do_exe_cmd([gcc, "--version"])
+        inputs["toolchain"] = output.splitlines()[0] if output else gcc
     else:
-        print(f" already exists {args.qcow2}, reusing it.")
-        do_exe_cmd(["qemu-nbd", "--disconnect", args.qcow2], print_output=True)
-        do_exe_cmd(["modprobe", "nbd", "max_part=19"], print_output=True)
+        ret, output, _ = do_exe_cmd(["docker", "image", "inspect", "-f", "{{.Id}}", args.docker_image])
+        if ret != 0:
+            return None
+        inputs["toolchain"] = output.strip()
+    pdebug(f"artifact inputs {inputs}")
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def check_artifact_members(args, release):
+    # 缓存内容: boot下本版本文件、模块、头文件、kernel.release及内核镜像(供run --direct)
+    members = [os.path.join("boot", name) for name in os.listdir(os.path.join(args.workdir, "boot"))
+               if release in name]
+    members += [os.path.join("lib", "modules", release),
+                os.path.join("usr", "src", f"linux-headers-{release}"),
+                os.path.join("build", "include", "config", "kernel.release")]
+    image = check_kernel_image(args)
+    if image:
+        members.append(os.path.relpath(image, args.workdir))
+    return [m for m in members if os.path.lexists(os.path.join(args.workdir, m))]
+
+
+@do_trace_func("copy")
+def do_artifact_restore(args, key):
+    bundle = os.path.join(args.artifact_cache_dir, f"{key}.tar")
+    if not os.path.isfile(bundle):
+        print(f" artifact cache miss {key[:16]}")
+        return False
+    print(f" artifact cache hit {key[:16]}, restore {bundle}")
+    try:
+        with tarfile.open(bundle, "r") as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(args.workdir, filter="data")
+            else:
+                tar.extractall(args.workdir)
+    except (OSError, tarfile.TarError) as e:
+        pwarn(f"restore {bundle} failed: {e}, build it")
+        return False
+    # 模块目录的build/source软链接指向编译目录，按当前workdir重建
+    release = check_kernel_release(args)
+    moddir = os.path.join(args.workdir, "lib", "modules", release or "")
+    if release and os.path.isdir(moddir):
+        for name, target in [("build", os.path.join(args.workdir, "build")), ("source", args.sourcedir)]:
+            link = os.path.join(moddir, name)
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(target, link)
+    # mtime作为最近使用时间，供LRU淘汰
+    os.utime(bundle)
+    return True
+
+
+@do_trace_func("copy")
+def do_artifact_store(args, key):
+    release = check_kernel_release(args)
+    if not release:
+        return 0
+    os.makedirs(args.artifact_cache_dir, exist_ok=True)
+    bundle = os.path.join(args.artifact_cache_dir, f"{key}.tar")
+    tmpfile = f"{bundle}.{os.getpid()}.{threading.get_ident()}"
+    try:
+        excluded = [os.path.join("lib", "modules", release, name) for name in ["build", "source"]]
+        with tarfile.open(tmpfile, "w") as tar:
+            for member in check_artifact_members(args, release):
+                tar.add(os.path.join(args.workdir, member), arcname=member,
+                        filter=lambda info: None if info.name in excluded else info)
+        os.replace(tmpfile, bundle)
+    except (OSError, tarfile.TarError) as e:
+        pwarn(f"store artifact {bundle} failed: {e}")
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        return 0
+    size = os.path.getsize(bundle)
+    print(f" artifact cache store {key[:16]} ({size // 1024 // 1024}MB)")
+    do_artifact_evict(args.artifact_cache_dir, check_size(args.artifact_cache_size))
+    return size
+
+
+def do_artifact_evict(cache_dir, limit):
+    # 按最近使用时间淘汰，直到总大小不超过上限
+    with open(os.path.join(cache_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        bundles = []
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".tar") and entry.is_file():
+                st = entry.stat()
+                bundles.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in bundles)
+        for _, size, path in sorted(bundles):
+            if total <= limit:
+                break
+            os.remove(path)
+            total -= size
+            print(f" artifact cache evict {os.path.basename(path)}")
 
-    # 如果参数或配置指定了nbd，则使用，否则挨个测试
-    if hasattr(args, 'nbd') and args.nbd is not None:
-        do_exe_cmd(f"qemu-nbd --disconnect {os.path.join('/dev/', args.nbd)}", print_output=True)
-        pdebug(f"try umount nbd /dev/{args.nbd}")
-        retcode, _, _ = do_exe_cmd(["qemu-nbd", "--connect", os.path.join("/dev/", args.nbd), args.qcow2],
-                                   print_output=True)
+
+def check_tmpfs_mounted(path):
+    with open("/proc/self/mounts", "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) > 2 and fields[1] == path and fields[2] == "tmpfs":
+                return True
+    return False
+
+
+def check_tree_size_kb(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total // 1024
+
+
+def check_tmpfs_estimate(args, build_dir, snapshot_dir):
+    # 优先使用上次tmpfs编译记录的目录大小，其次已有的编译目录/快照，否则使用默认值
+    try:
+        with open(os.path.join(args.workdir, "kdev-build-report.json"), "r") as f:
+            recorded = json.load(f).get("build_tree_kb")
+    except (OSError, ValueError):
+        recorded = None
+    if recorded:
+        return recorded
+    for path in [snapshot_dir, build_dir]:
+        if os.path.isdir(path) and not check_tmpfs_mounted(path) and os.listdir(path):
+            return check_tree_size_kb(path)
+    return TMPFS_DEFAULT_KB
+
+
+@do_trace_func("copy")
+def do_mount_build_tmpfs(args):
+    # O=目录放到内存，编译产物(boot/modules/headers)仍安装到workdir
+    build_dir = os.path.join(args.workdir, "build")
+    snapshot_dir = os.path.join(args.workdir, "build.snapshot")
+    if args.tmpfs_snapshot and shutil.which("rsync") is None:
+        pwarn("rsync not found, build snapshot disabled")
+        args.tmpfs_snapshot = None
+    if check_tmpfs_mounted(build_dir):
+        print(f" reuse tmpfs {build_dir}")
+        return True
+    check_privilege()
+    estimate = check_tmpfs_estimate(args, build_dir, snapshot_dir)
+    # 编译目录增长余量50%
+    size = check_size(args.tmpfs_size) // 1024 if args.tmpfs_size else max(TMPFS_DEFAULT_KB // 4, estimate * 3 // 2)
+    need = size + int(args.job) * check_job_mem_estimate(args, "build")
+    available = check_mem_available()
+    if available < need:
+        pwarn(f"MemAvailable {available // 1024}MB < {need // 1024}MB (tree {size // 1024}MB + jobs), "
+              f"build on disk")
+        return False
+    os.makedirs(build_dir, exist_ok=True)
+    retcode, _, error = do_exe_cmd(["mount", "-t", "tmpfs", "-o", f"size={size}k,mode=0755", "kdev-build",
+                                    build_dir], print_output=True)
+    if retcode != 0:
+        pwarn(f"mount tmpfs on {build_dir} failed: {error}, build on disk")
+        return False
+    print(f" mount tmpfs {build_dir} size {size // 1024}MB (estimate {estimate // 1024}MB)")
+    if args.tmpfs_snapshot and os.path.isdir(snapshot_dir):
+        start = time.monotonic()
+        retcode, _, _ = do_exe_cmd(["rsync", "-a", f"{snapshot_dir}/", f"{build_dir}/"], print_output=True)
         if retcode != 0:
-            perror("Connect nbd failed!")
+            pwarn(f"restore {snapshot_dir} failed, do a full build")
+            do_exe_cmd(["find", build_dir, "-mindepth", "1", "-delete"])
+        else:
+            print(f" restore build snapshot in {time.monotonic() - start:.1f}s")
+    return True
+
+
+@do_trace_func("copy")
+def do_save_build_snapshot(args):
+    # 只写入变化的文件，重启后增量编译可从快照继续
+    build_dir = os.path.join(args.workdir, "build")
+    snapshot_dir = os.path.join(args.workdir, "build.snapshot")
+    start = time.monotonic()
+    os.makedirs(snapshot_dir, exist_ok=True)
+    retcode, _, error = do_exe_cmd(["rsync", "-a", "--delete", f"{build_dir}/", f"{snapshot_dir}/"],
+                                   print_output=True)
+    if retcode != 0:
+        pwarn(f"save build snapshot to {snapshot_dir} failed: {error}")
     else:
-        for nbd in ["nbd" + str(i) for i in range(9)]:
-            retcode, output, error = do_exe_cmd(
-                ["qemu-nbd", "--connect", "/dev/" + nbd,
-                 args.qcow2],
-                print_output=True)
-            if retcode == 0:
-                args.nbd = nbd
-                break
-        if not hasattr(args, 'nbd'):
-            perror("No available nbd found!")
+        print(f" save build snapshot {snapshot_dir} in {time.monotonic() - start:.1f}s")
 
-    # 稍作延迟
-    do_exe_cmd("sync")
 
-    # 创建临时挂载点
-    args.tmpdir = "/tmp/qcow2-" + str(random.randint(0, 9999))
-    os.makedirs(args.tmpdir, exist_ok=True)
-    retcode, _, _ = do_exe_cmd(f"mount -o rw /dev/{args.nbd}p1 {args.tmpdir}", print_output=True)
+def do_umount_build_tmpfs(args):
+    build_dir = os.path.join(args.workdir, "build")
+    if not check_tmpfs_mounted(build_dir):
+        print(f"no tmpfs mounted on {build_dir}")
+        return
+    retcode, _, error = do_exe_cmd(["umount", build_dir], print_output=True)
     if retcode != 0:
-        perror("Mount qcow2 failed!")
+        print(f"umount tmpfs {build_dir} failed! {error}")
+    else:
+        print(f"umount tmpfs {build_dir} done!")
+
+
+def do_bench_build_once(args, scenario, job, rebuild):
+    bench_args = copy.copy(args)
+    bench_args.job = job
+    bench_args.rebuild = rebuild
+    bench_args.quiet = True
+    report = do_build_kernel(bench_args)
+    cpu = sum(p.get("user", 0) + p.get("sys", 0) for p in report["phases"])
+    result = {
+        "scenario": scenario,
+        "job": job,
+        "build_mode": bench_args.build_mode,
+        "retcode": report["retcode"],
+        "wall": report["wall"],
+        "cpu": round(cpu, 3),
+        # 平均占用的CPU核数
+        "cpu_util": round(cpu / report["wall"], 2) if report["wall"] else 0.0,
+        "maxrss_kb": max([p.get("maxrss_kb", 0) for p in report["phases"]] or [0]),
+        "phases": report["phases"],
+    }
+    print(f" [{scenario} -j{job}] {result['build_mode']} retcode={result['retcode']} wall={result['wall']}s "
+          f"cpu_util={result['cpu_util']} maxrss={result['maxrss_kb']}KB")
+    return result
 
-    # 稍作延迟
-    do_exe_cmd("sync")
-
-    # 拷贝boot目录，包含linux vmlinuz config maps
-    copy_bootdir = os.path.join(args.workdir, "boot")
-    qcow_bootdir = os.path.join(args.tmpdir, "boot")
-    if os.path.isdir(copy_bootdir) and qcow_bootdir != "/boot":
-        copy_cmd = ["/usr/bin/cp", "-a"] + glob.glob(f"{copy_bootdir}/*") + [f"{qcow_bootdir}/"]
-        retcode, _, error = do_exe_cmd(copy_cmd)
-        if retcode == 0:
-            print(f" copy vmlinuz/config ok! {qcow_bootdir}")
-        else:
-            perror(f" copy vmlinuz/config failed!! {qcow_bootdir} {error}")
-
-    # 稍作延迟
-    do_exe_cmd("sync")
-
-    # 拷贝lib目录，包含inbox核外驱动
-    copy_libdir = os.path.join(args.workdir, "lib/modules")
-    qcow_libdir = os.path.join(args.tmpdir, "lib/modules")
-    if os.path.isdir(copy_libdir) and qcow_libdir != "/lib/modules":
-        copy_cmd = ["/usr/bin/cp", "-a"] + glob.glob(f"{copy_libdir}/*") + [f"{qcow_libdir}/"]
-        retcode, _, _ = do_exe_cmd(copy_cmd)
-        if retcode == 0:
-            print(f" copy modules(stripped) ok! {qcow_libdir}")
+
+def handle_bench_build(args):
+    handle_check(args)
+    # 使用独立的workdir，避免全量编译清掉日常编译目录
+    args.workdir = os.path.join(args.workdir, "bench")
+    ncpu = int(args.job) if args.job else os.cpu_count()
+    if args.jobs:
+        sweep = [int(j) for j in args.jobs.split(",")]
+    else:
+        sweep = sorted(set([1, max(1, ncpu // 2), ncpu, ncpu * 3 // 2, ncpu * 2]))
+    scenarios = args.scenarios.split(",")
+    for scenario in scenarios:
+        if scenario not in ["clean", "noop", "touch", "jobs"]:
+            perror(f"unknown bench scenario {scenario}")
+    touch_file = os.path.join(args.sourcedir, args.touch)
+    docker_image = None
+    if not args.nodocker:
+        ok, docker_image = check_docker_image(args)
+        if not ok:
+            perror("not useable docker image found!")
+    print(f" bench workdir {args.workdir}, scenarios {','.join(scenarios)}, -j sweep {sweep}")
+
+    results = []
+    if "clean" in scenarios or "noop" in scenarios or "touch" in scenarios:
+        results.append(do_bench_build_once(args, "clean", ncpu, True))
+    if "noop" in scenarios:
+        results.append(do_bench_build_once(args, "noop", ncpu, None))
+    if "touch" in scenarios:
+        if not os.path.isfile(touch_file):
+            perror(f"touch file {touch_file} not found!")
+        os.utime(touch_file)
+        results.append(do_bench_build_once(args, "touch", ncpu, None))
+    if "jobs" in scenarios:
+        for job in sweep:
+            results.append(do_bench_build_once(args, "jobs", job, True))
+    if "clean" not in scenarios:
+        results = [r for r in results if r["scenario"] != "clean"]
+
+    bench = {
+        "kdev": CURRENT_VERSION,
+        "start": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "host": os.uname().nodename,
+        "cpus": os.cpu_count(),
+        "job_budget": check_job_budget(),
+        "kernelversion": args.kernelversion,
+        "arch": args.arch,
+        "config": args.config or f"debian_{args.arch}_defconfig",
+        "docker_image": docker_image,
+        "results": results,
+    }
+    output = args.output or os.path.join(args.workdir, "kdev-bench-build.json")
+    with open(output, "w") as f:
+        json.dump(bench, f, indent=4)
+
+    print(f" {'scenario':<10} {'job':>4} {'mode':>12} {'wall(s)':>10} {'cpu(s)':>10} {'util':>6} {'maxrss(KB)':>12}")
+    for r in results:
+        wall = r["wall"] if r["retcode"] == 0 else "failed"
+        print(f" {r['scenario']:<10} {r['job']:>4} {r['build_mode']:>12} {wall:>10} {r['cpu']:>10} "
+              f"{r['cpu_util']:>6} {r['maxrss_kb']:>12}")
+    sweep_ok = [r for r in results if r["scenario"] == "jobs" and r["retcode"] == 0]
+    if sweep_ok:
+        best = min(sweep_ok, key=lambda r: r["wall"])
+        print(f" fastest clean build with -j{best['job']} ({best['wall']}s)")
+    print(f" bench report : {output}")
+    if any(r["retcode"] != 0 for r in results):
+        perror("some bench builds failed!")
+    print("handle bench build done!")
+
+
+def check_cgroup_path(controller):
+    # 返回当前进程所在cgroup目录，兼容v1/v2
+    try:
+        with open("/proc/self/cgroup", "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers == "" and os.path.isfile("/sys/fs/cgroup/cgroup.controllers"):
+            return os.path.join("/sys/fs/cgroup", path.lstrip("/"))
+        if controller in controllers.split(","):
+            for base in [f"/sys/fs/cgroup/{controllers}", f"/sys/fs/cgroup/{controller}"]:
+                if os.path.isdir(os.path.join(base, path.lstrip("/"))):
+                    return os.path.join(base, path.lstrip("/"))
+                if os.path.isdir(base):
+                    return base
+    return None
+
+
+def check_read_file(path, default=None):
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return default
+
+
+def check_cpu_limit():
+    # cpuset及cgroup cpu配额共同决定可用CPU数
+    cpus = len(os.sched_getaffinity(0))
+    cgroup = check_cgroup_path("cpu")
+    if cgroup:
+        quota, period = None, None
+        cpu_max = check_read_file(os.path.join(cgroup, "cpu.max"))
+        if cpu_max:
+            fields = cpu_max.split()
+            if fields[0] != "max":
+                quota, period = int(fields[0]), int(fields[1])
         else:
-            perror(f" copy modules(stripped) failed!! {qcow_libdir}")
-
-    # 稍作延迟
-    do_exe_cmd("sync")
-
-    # 拷贝内核头文件
-    copy_headerdir = os.path.join(args.workdir, "usr")
-    qcow_headerdir = os.path.join(args.tmpdir, "usr")
-    if os.path.isdir(copy_headerdir) and qcow_headerdir != "/usr":
-        copy_cmd = ["/usr/bin/cp", "-a"] + glob.glob(f"{copy_headerdir}/*") + [f"{qcow_headerdir}/"]
-        retcode, _, _ = do_exe_cmd(copy_cmd)
-        if retcode == 0:
-            print(f" copy headers ok! {qcow_headerdir}")
+            quota = int(check_read_file(os.path.join(cgroup, "cpu.cfs_quota_us"), "-1"))
+            period = int(check_read_file(os.path.join(cgroup, "cpu.cfs_period_us"), "100000"))
+        if quota and quota > 0 and period:
+            cpus = min(cpus, max(1, -(-quota // period)))
+    return cpus
+
+
+def check_mem_available():
+    # MemAvailable与cgroup内存上限剩余量取较小值，单位KB
+    available = 0
+    for line in (check_read_file("/proc/meminfo", "") or "").splitlines():
+        if line.startswith("MemAvailable:"):
+            available = int(line.split()[1])
+    cgroup = check_cgroup_path("memory")
+    if cgroup:
+        limit = check_read_file(os.path.join(cgroup, "memory.max")) or \
+            check_read_file(os.path.join(cgroup, "memory.limit_in_bytes"))
+        usage = check_read_file(os.path.join(cgroup, "memory.current")) or \
+            check_read_file(os.path.join(cgroup, "memory.usage_in_bytes"))
+        if limit and limit.isdigit() and usage and usage.isdigit() and int(limit) < (1 << 60):
+            available = min(available, max(0, int(limit) - int(usage)) // 1024)
+    return available
+
+
+def check_job_budget(mem_per_job_kb=MEM_PER_JOB_KB):
+    cpus = check_cpu_limit()
+    mem_jobs = max(1, check_mem_available() // mem_per_job_kb)
+    budget = max(1, min(cpus, mem_jobs))
+    pdebug(f"job budget {budget} (cpu {cpus}, memory {mem_jobs})")
+    return budget
+
+
+def check_job_mem_estimate(args, phase):
+    # 从上次编译报告估算单个job的内存，没有报告时使用默认值
+    report_file = os.path.join(args.workdir, "kdev-build-report.json")
+    try:
+        with open(report_file, "r") as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return MEM_PER_JOB_KB
+    for result in report.get("phases", []):
+        if result.get("name") != phase or result.get("retcode") != 0 or not result.get("maxrss_kb"):
+            continue
+        if report.get("docker_image"):
+            # docker统计的是容器cgroup峰值，按job数平摊
+            estimate = result["maxrss_kb"] // max(1, int(report.get(f"{phase}_job") or report.get("job") or 1))
         else:
-            perror(f" copy headers failed!! {qcow_headerdir}")
+            # wait4返回的是最大的单个子进程RSS，即单个job的内存
+            estimate = result["maxrss_kb"]
+        # 预留余量，并不低于默认值的一半
+        return max(MEM_PER_JOB_KB // 2, estimate * 5 // 4)
+    return MEM_PER_JOB_KB
+
+
+def check_auto_job(args, phase):
+    mem_per_job_kb = check_job_mem_estimate(args, phase)
+    job = check_job_budget(mem_per_job_kb)
+    print(f" auto job for {phase} : {job} (estimate {mem_per_job_kb // 1024}MB per job)")
+    return job
+
+
+def check_matrix_targets(matrix):
+    # 格式: arch[:config],arch[:config]...
+    targets = []
+    for item in matrix.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        arch, _, config = item.partition(":")
+        if arch not in ["x86_64", "arm64"]:
+            perror(f"Unsupported arch {arch} in matrix target {item}")
+        targets.append((arch, config or f"debian_{arch}_defconfig"))
+    if not targets:
+        perror(f"no matrix target found in {matrix}")
+    return targets
+
+
+def do_build_matrix(args):
+    # 多目标共享全局job预算，每个目标独立的workdir及O=目录
+    targets = check_matrix_targets(args.matrix)
+    # -j 作为上限，实际预算受cgroup及可用内存约束
+    if args.job in [None, "auto"]:
+        budget = check_auto_job(args, "build")
+    else:
+        budget = min(int(args.job), check_job_budget())
+    slots = min(len(targets), max(1, budget // MATRIX_MIN_JOBS))
+    print(f" matrix {len(targets)} targets, job budget {budget}, {slots} targets in parallel")
+    pending = collections.deque(targets)
+    state = {"free": budget, "running": 0}
+    lock = threading.Lock()
+    results = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                arch, config = pending.popleft()
+                # 剩余目标较少时把空闲的job分给正在启动的目标
+                share = min(slots - state["running"], len(pending) + 1)
+                jobs = max(1, state["free"] // share)
+                state["free"] -= jobs
+                state["running"] += 1
+            target_args = copy.copy(args)
+            target_args.arch = arch
+            target_args.config = config
+            target_args.job = jobs
+            target_args.quiet = True
+            target_args.workdir = os.path.join(args.workdir, "matrix", f"{arch}-{config}")
+            print(f" [{arch}:{config}] start with -j{jobs} in {target_args.workdir}")
+            start = time.monotonic()
+            try:
+                report = do_build_kernel(target_args)
+            except SystemExit:
+                report = {"retcode": 1, "failed": ["setup"], "phases": []}
+            except Exception:
+                # 异常不能让线程退出，否则该目标及排队的目标都没有结果
+                pwarn(f"[{arch}:{config}] build raised exception\n{traceback.format_exc()}")
+                report = {"retcode": 1, "failed": ["exception"], "phases": []}
+            finally:
+                with lock:
+                    state["free"] += jobs
+                    state["running"] -= 1
+            result = {
+                "arch": arch,
+                "config": config,
+                "workdir": target_args.workdir,
+                "job": jobs,
+                "retcode": report["retcode"],
+                "failed": report.get("failed", []),
+                "wall": round(time.monotonic() - start, 3),
+                "phases": report["phases"],
+            }
+            print(f" [{arch}:{config}] done retcode={result['retcode']} wall={result['wall']}s")
+            with lock:
+                results.append(result)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=worker) for _ in range(slots)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    results.sort(key=lambda r: targets.index((r["arch"], r["config"])))
+    summary = {
+        "kdev": CURRENT_VERSION,
+        "start": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "kernelversion": args.kernelversion,
+        "job_budget": budget,
+        "parallel": slots,
+        "wall": round(time.monotonic() - start, 3),
+        "targets": results,
+    }
+    report_file = os.path.join(args.workdir, "kdev-matrix-report.json")
+    with open(report_file, "w") as f:
+        json.dump(summary, f, indent=4)
+
+    print(f" {'target':<40} {'job':>4} {'result':>8} {'wall(s)':>10}")
+    for r in results:
+        status = "ok" if r["retcode"] == 0 else "failed"
+        print(f" {r['arch'] + ':' + r['config']:<40} {r['job']:>4} {status:>8} {r['wall']:>10}")
+    print(f" matrix report : {report_file}")
+    failed = [f"{r['arch']}:{r['config']}" for r in results if r["retcode"] != 0]
+    if failed:
+        perror(f"matrix build {', '.join(failed)} failed!")
 
-    # 稍作延迟
-    do_exe_cmd("sync")
 
+def handle_rootfs(args):
+    handle_check(args)
+    check_rootfs_image(args)
+    os.chdir(args.workdir)
+    do_rootfs_mount(args)
+
+    # 增量注入boot(vmlinuz config maps)、lib/modules(inbox核外驱动)及内核头文件
+    do_inject_tree(args.workdir, args.tmpdir, ["boot", "lib/modules", "usr"])
+    do_syncfs(args.tmpdir)
+    do_rootfs_setup(args)
+    do_rootfs_umount(args)
+    print("handle rootfs done!")
+
+
+def do_rootfs_mount(args):
+    do_prepare_overlay(args)
+    # 如果参数或配置指定了nbd，则使用，否则由nbd锁分配
+    args.nbd = do_nbd_connect(args.overlay, nbd=getattr(args, "nbd", None), discard=args.compact)
+
+    # 创建临时挂载点
+    args.tmpdir = tempfile.mkdtemp(prefix="qcow2-")
+    if do_nbd_mount(args.nbd, args.tmpdir) != 0:
+        perror("Mount qcow2 failed!")
+
+
+def do_rootfs_setup(args):
     # 设置主机名
     args.hostname = args.qcow2.split(".")[0]
     qcow_hostname = os.path.join(args.tmpdir, "etc/hostname")
@@ -679,55 +3218,67 @@ def handle_rootfs(args):
             os.rename(os.path.join(TMP_USRBIN, item), os.path.join(TMP_USRBIN, new_item))
             print(f"Renamed {item} to {new_item}")
 
-    # 写入初始化脚本，开机第一次执行
-    with open(os.path.join(args.tmpdir, "etc/firstboot"), "w") as f:
-        f.write("")
-    with open(os.path.join(args.tmpdir, "etc/rc.local"), "w") as f:
-        f.write("""#!/bin/bash
-
-if [ -f /etc/firstboot ]; then
-	rm -f /etc/firstboot
-	cd /boot
-	for k in $(ls vmlinuz-*); do
-		KERNEL=${k//vmlinuz-/}
-		update-initramfs -k ${KERNEL} -c
-	done
-	if which update-grub2 &> /dev/null ; then
-	    update-grub2
-	fi
-	sync
-	if which chpasswd &> /dev/null ; then
-		echo root:linux | chpasswd
-	elif which passwd &> /dev/null ; then
-		echo linux | passwd -stdin root
-	else
-		echo "can't reset root passwd"
-	fi
-	if [ -d /etc/cloud/ ]; then
-		touch /etc/cloud/cloud-init.disabled
-		rm -f /usr/bin/cloud-*
-	fi
-	if which ssh-keygen &> /dev/null ; then
-	    ssh-keygen -A
-	fi
-	sync
-	reboot -f
-fi
+    # 优先在主机上生成initramfs，失败时写入初始化脚本，开机第一次执行
+    release = check_kernel_release(args)
+    if release and do_chroot_initramfs(args, args.tmpdir, release):
+        if os.path.isfile(os.path.join(args.tmpdir, "etc/firstboot")):
+            os.remove(os.path.join(args.tmpdir, "etc/firstboot"))
+        print(f" initramfs and boot entry of {release} ready, no firstboot reboot needed")
+    else:
+        do_write_firstboot(args.tmpdir, release)
 
-exit 0
 
-""")
-    os.chmod(os.path.join(args.tmpdir, "etc/rc.local"), 0o755)
-    print(" set rc.local done!")
+def do_rootfs_umount(args):
+    do_syncfs(args.tmpdir)
+    if args.compact:
+        do_exe_cmd(["fstrim", "-v", args.tmpdir], print_output=True)
     print(" clean ...")
-    retcode, _, _ = do_exe_cmd(f"umount -l {args.tmpdir}", print_output=True)
-    if retcode != 0:
-        print("Umount failed!")
-    retcode, _, _ = do_exe_cmd(f"qemu-nbd --disconnect /dev/{args.nbd}", print_output=True)
+    retcode = do_nbd_disconnect(args.nbd)
     if retcode != 0:
         print("Disconnect nbd failed!")
     os.rmdir(args.tmpdir)
-    print("handle rootfs done!")
+    args.tmpdir = None
+    if args.compact and retcode == 0:
+        do_compact_overlay(args)
+
+
+@do_trace_func("copy")
+def do_compact_overlay(args):
+    # 只重写overlay自身的数据(-B保持backing)，压缩并多协程乱序写
+    backing = os.path.join(args.workdir, args.qcow2)
+    tmpfile = args.overlay + ".compact"
+    before = os.path.getsize(args.overlay)
+    start = time.monotonic()
+    retcode, _, error = do_exe_cmd(["qemu-img", "convert", "-c", "-O", "qcow2",
+                                    "-B", backing, "-F", "qcow2",
+                                    "-m", str(min(16, os.cpu_count())), "-W",
+                                    args.overlay, tmpfile], print_output=True)
+    if retcode != 0:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        pwarn(f"compact {args.overlay} failed! {error}")
+        return
+    os.replace(tmpfile, args.overlay)
+    after = os.path.getsize(args.overlay)
+    print(f" compact {args.overlay} {before // 1024 // 1024}MB -> {after // 1024 // 1024}MB "
+          f"in {time.monotonic() - start:.1f}s")
+
+
+def check_vm_args(args):
+    if args.arch == "x86_64":
+        args.vmarch = "x86_64"
+        if not args.vmcpu:
+            args.vmcpu = "8"
+        if not args.vmram:
+            args.vmram = "8192"
+    elif args.arch == "arm64":
+        args.vmarch = "aarch64"
+        if not args.vmcpu:
+            args.vmcpu = "2"
+        if not args.vmram:
+            args.vmram = "4096"
+    else:
+        perror(f"unsupported arch {args.arch}")
 
 
 def handle_run(args):
@@ -756,25 +3307,19 @@ def handle_run(args):
         print(f"virsh is found in the system at {path}.")
 
     # 检查是否有可用的QCOW2文件
-    ok, image_url = check_qcow_image(args)
-    if not ok:
-        perror(" no available image found!")
-    print(f" using qcows url {image_url}")
+    check_rootfs_image(args)
+    check_vm_args(args)
 
-    args.qcow2_url = image_url
-    args.qcow2 = os.path.basename(image_url)
-    print(f" qcow2 name : {args.qcow2}")
+    if args.direct:
+        sys.exit(do_run_direct(args))
 
     os.chdir(args.workdir)
-    if not os.path.isfile(args.qcow2):
-        print(" no qcow2 found!")
+    if not os.path.isfile(args.overlay):
+        print(" no qcow2 overlay found!")
         print("Tips: run `kdev rootfs`")
         sys.exit(1)
     else:
-        print(f" found qcow2 {args.qcow2} in workdir, using it.")
-
-    if not hasattr(args, "name") or args.name is None:
-        args.name = f"linux-{args.masterversion}-{args.arch}"
+        print(f" found qcow2 overlay {args.overlay} in workdir, using it.")
 
     print(f" try startup {args.name}")
     retcode, args.vmstat, _ = do_exe_cmd(f"virsh domstate {args.name}", print_output=False)
@@ -791,21 +3336,6 @@ def handle_run(args):
 
     print(f" {args.name} does't exists! create new vm")
 
-    if args.arch == "x86_64":
-        args.vmarch = "x86_64"
-        if not args.vmcpu:
-            args.vmcpu = "8"
-        if not args.vmram:
-            args.vmram = "8192"
-    elif args.arch == "arm64":
-        args.vmarch = "aarch64"
-        if not args.vmcpu:
-            args.vmcpu = "2"
-        if not args.vmram:
-            args.vmram = "4096"
-    else:
-        perror(f"unsupported arch {args.arch}")
-
     qemu_cmd = f"virt-install  " \
                f"  --name {args.name} " \
                f"  --arch {args.vmarch} " \
@@ -813,7 +3343,7 @@ def handle_run(args):
                f"  --os-type=linux " \
                f"  --video=vga " \
                f"  --vcpus {args.vmcpu}  " \
-               f"  --disk path={os.path.join(args.workdir, args.qcow2)},format=qcow2,bus=scsi " \
+               f"  --disk path={args.overlay},format=qcow2,bus=scsi " \
                f"  --network bridge=br0,virtualport_type=openvswitch " \
                f"  --import " \
                f"  --graphics spice,listen=0.0.0.0 " \
@@ -829,10 +3359,10 @@ def handle_run(args):
 
 def handle_clean(args):
     handle_check(args)
+    if not hasattr(args, "name") or args.name is None:
+        args.name = f"linux-{args.masterversion}-{args.arch}"
     # 清理虚拟机配置，保留qcow2
     if args.vm or args.all:
-        if not hasattr(args, "name"):
-            args.name = f"linux-{args.masterversion}-{args.arch}"
         retcode, _, _ = do_exe_cmd(f"virsh domstate {args.name}", print_output=False)
         if 0 == retcode:
             retcode, _, _ = do_exe_cmd(f"virsh destroy {args.name}", print_output=True)
@@ -847,16 +3377,29 @@ def handle_clean(args):
                 print(f" undefine vm {args.name} failed!")
         else:
             print(f"no vm {args.name} found! skip clean vm.")
-    # 清理qcow2，保留虚机配置
+    if args.qcow or args.base or args.all:
+        check_rootfs_image(args)
+    # 清理qcow2 overlay，保留虚机配置及下载的镜像
     if args.qcow or args.all:
-        os.chdir(args.workdir)
-        for filename in os.listdir('.'):
-            if filename.endswith(".qcow2"):
-                pdebug(f" Find qcow2 {filename}")
-                filepath = os.path.join(args.workdir, filename)
-                os.remove(filepath)
-                print(f"Deleted {filepath}")
+        if os.path.isfile(args.overlay):
+            os.remove(args.overlay)
+            print(f"Deleted {args.overlay}")
+    # 清理下载的镜像
+    if args.base or args.all:
+        filepath = os.path.join(args.workdir, args.qcow2)
+        # 仍有overlay以其为backing file时不能删除
+        for name in os.listdir(args.workdir):
+            overlay = os.path.join(args.workdir, name)
+            if name.endswith(".qcow2") and os.path.isfile(overlay) and overlay != filepath and \
+                    check_overlay_backing(overlay) == os.path.abspath(filepath):
+                perror(f"{filepath} is the backing file of {overlay}! Tips: run `kdev clean --qcow` first")
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+            print(f"Deleted {filepath}")
+    if args.tmpfs or args.all:
+        do_umount_build_tmpfs(args)
     if args.docker or args.all:
+        do_clean_warm_containers()
         retcode, _, _ = do_exe_cmd(f"docker container prune -f", print_output=True)
         if 0 == retcode:
             print("clean docker container done!")
@@ -869,18 +3412,6 @@ def handle_clean(args):
 def handle_image(args):
     check_privilege()
 
-    # 定义一个函数，判断一个路径是否是nbd开头的目录
-    def is_nbd_dir(path):
-        return os.path.isdir(path) and os.path.basename(path).startswith("nbd")
-
-    def find_free_nbd():
-        for entry in os.listdir("/sys/block/"):
-            full_path = os.path.join("/sys/block/", entry)
-            if is_nbd_dir(full_path):
-                if not os.path.exists(os.path.join(full_path, "pid")):
-                    return os.path.basename(full_path)
-        return ''
-
     if args.mount:
         print("mount file :", args.mount)
         # 检查文件是否存在
@@ -888,20 +3419,15 @@ def handle_image(args):
             # 获取文件的绝对路径
             file = os.path.abspath(args.mount)
 
-            nbd = find_free_nbd()
-            if '' == nbd:
-                perror("no available /dev/nbd found!")
-            print(f"try mount {file} to /dev/{nbd}")
-            ok, _, _ = do_exe_cmd(f"qemu-nbd -c /dev/{nbd} {file}", print_output=True)
-            if 0 != ok:
-                perror(f"qemu-nbd bind {file} failed! retcode={ok}")
-            else:
-                print(f"qemu-nbd bind {file} done!")
+            if do_nbd_find(file) is not None:
+                perror(f"{file} is already connected to /dev/{do_nbd_find(file)}!")
+            nbd = do_nbd_connect(file, persistent=True)
+            print(f"qemu-nbd bind {file} to /dev/{nbd} done!")
             mntdir = file + '-mnt'
             os.makedirs(mntdir, exist_ok=True)
-            time.sleep(3)
-            ok, _, _ = do_exe_cmd(f"mount /dev/{nbd}p1 {mntdir}", print_output=True)
+            ok = do_nbd_mount(nbd, mntdir)
             if 0 != ok:
+                do_nbd_disconnect(nbd)
                 perror(f"mount {file} failed! retcode={ok}")
             else:
                 print(f"mount {args.mount} to {mntdir} done!")
@@ -918,21 +3444,28 @@ def handle_image(args):
             mnt_dir = file + "-mnt"
             if os.path.isdir(mnt_dir):
                 retcode, _, _ = do_exe_cmd(f"umount {mnt_dir}")
-                time.sleep(1)
                 print(f"try umount {file} ret={retcode}")
                 if len(os.listdir(mnt_dir)) != 0:
                     perror(f"{mnt_dir} is not empty! umount failed! keep mount dir empty!")
                 print(f"{mnt_dir} is already empty!")
-            # disconnect nbd
-            do_clean_nbd()
+            # 只断开连接该镜像的nbd设备
+            nbd = do_nbd_find(file)
+            if nbd is None:
+                print(f"no nbd connected to {file}")
+            elif do_nbd_disconnect(nbd) != 0:
+                print(f"umount {nbd} failed!")
+            else:
+                print(f"umount {nbd} done!")
         else:
             # 打印错误信息
             print(f"File {args.umount} does not exist")
 
 
 def main():
-    global DEBUG, CURRENT_VERSION
+    global DEBUG, CURRENT_VERSION, TRACE_EVENTS
     check_python_version()
+    # SIGTERM时正常退出，保证atexit清理(释放nbd等)得以执行
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
 
     # 顶层解析
     parser = argparse.ArgumentParser(add_help=False)
@@ -950,6 +3483,7 @@ def main():
     parent_parser.add_argument("-w", "--workdir", default=None, help="setup workdir")
     parent_parser.add_argument('-l', '--log', default=None, help="log file path")
     parent_parser.add_argument('-d', '--debug', default=None, action="store_true", help="enable debug output")
+    parent_parser.add_argument('--trace', default=None, help="write a chrome trace event json of this run")
 
     # 添加子命令 init
     parser_init = subparsers.add_parser('init', parents=[parent_parser])
@@ -963,14 +3497,57 @@ def main():
     parser_kernel = subparsers.add_parser('kernel', parents=[parent_parser])
     parser_kernel.add_argument("--nodocker", default=None, action="store_true",
                                help="build kernel without docker environment")
-    parser_kernel.add_argument("-j", "--job", default=os.cpu_count(), help="setup compile job number")
+    parser_kernel.add_argument("-j", "--job", default="auto",
+                               help="setup compile job number, default is auto (cpu quota and memory)")
+    parser_kernel.add_argument("-q", "--quiet", default=None, action="store_true",
+                               help="do not print build output, only write it to log")
     parser_kernel.add_argument("-c", "--clean", help="clean docker when exit")
     parser_kernel.add_argument("--config", help="setup kernel build config")
-    parser_kernel.set_defaults(func=handle_kernel)
+    parser_kernel.add_argument("--matrix", default=None,
+                               help="build several targets under one job budget, e.g. x86_64,arm64:defconfig")
+    parser_kernel.add_argument("--rebuild", default=None, action="store_true",
+                               help="force full rebuild (make mrproper), default is incremental")
+    parser_kernel.add_argument("--warm", default=None, action="store_true",
+                               help="build in a per-workdir container kept alive between builds")
+    parser_kernel.add_argument("--warm-timeout", default=1800, type=int,
+                               help="stop the warm container after idle seconds, default is 1800")
+    parser_kernel.add_argument("--ccache", default=None, action="store_true",
+                               help="build with ccache, cache dir is shared by docker and host build")
+    parser_kernel.add_argument("--ccache-dir", default=None,
+                               help="setup ccache dir, default is ~/.cache/kdev/ccache")
+    parser_kernel.add_argument("--ccache-size", default="20G", help="setup ccache max size, default is 20G")
+    parser_kernel.add_argument("--module-compress", default=None, choices=["auto", "zstd", "xz", "none"],
+                               help="compress modules at modules_install, auto is zstd on 5.13+ and xz before")
+    parser_kernel.add_argument("--artifact-cache", default=None, action="store_true",
+                               help="restore build artifacts keyed on build inputs, store them after each build")
+    parser_kernel.add_argument("--artifact-cache-dir", default=None,
+                               help="setup artifact cache dir, default is ~/.cache/kdev/artifacts")
+    parser_kernel.add_argument("--artifact-cache-size", default="20G",
+                               help="setup artifact cache max size, default is 20G")
+    parser_kernel.add_argument("--tmpfs", default=None, action="store_true",
+                               help="put the object tree <workdir>/build on tmpfs, fall back to disk if memory is low")
+    parser_kernel.add_argument("--tmpfs-size", default=None,
+                               help="setup tmpfs size, default is 1.5x the estimated object tree")
+    parser_kernel.add_argument("--tmpfs-snapshot", default=None, action="store_true",
+                               help="restore/save the tmpfs object tree from <workdir>/build.snapshot")
+    parser_kernel.add_argument("--metrics-dir", default=None,
+                               help="write build progress to a node-exporter textfile collector dir")
+    parser_kernel.add_argument("--deploy", default=None, action="store_true",
+                               help="install kernel, modules and headers directly into the rootfs overlay")
+    parser_kernel.add_argument('-n', '--name', help="setup vm name for --deploy, rootfs overlay is <name>.qcow2")
+    parser_kernel.set_defaults(func=handle_kernel, compact=None)
 
     # 添加子命令 rootfs
     parser_rootfs = subparsers.add_parser('rootfs', parents=[parent_parser])
     parser_rootfs.add_argument('-r', '--release', default=None, action="store_true")
+    parser_rootfs.add_argument('-n', '--name', help="setup vm name, rootfs overlay is <name>.qcow2")
+    parser_rootfs.add_argument('--fresh', default=None, action="store_true",
+                               help="recreate rootfs overlay from the downloaded image")
+    parser_rootfs.add_argument('--image-cache', default=None,
+                               help="setup shared image cache dir, default is ~/.cache/kdev/images")
+    parser_rootfs.add_argument('--download-threads', default=4, help="setup parallel download threads")
+    parser_rootfs.add_argument('--compact', default=None, action="store_true",
+                               help="discard free blocks and recompress the overlay after injection")
     parser_rootfs.set_defaults(func=handle_rootfs)
 
     # 添加子命令 run
@@ -978,13 +3555,63 @@ def main():
     parser_run.add_argument('-n', '--name', help="setup vm name")
     parser_run.add_argument('--vmcpu', help="setup vm vcpu number")
     parser_run.add_argument('--vmram', help="setup vm ram")
+    parser_run.add_argument('--direct', default=None, action="store_true",
+                            help="boot built kernel directly with qemu -kernel, modules shared by 9p")
+    parser_run.add_argument('--kernel', help="setup kernel image for --direct, default is built bzImage/Image")
+    parser_run.add_argument('--append', help="append kernel cmdline for --direct")
+    parser_run.add_argument('--busybox', help="setup static busybox for --direct initramfs")
     parser_run.set_defaults(func=handle_run)
 
+    # 添加子命令 bench
+    parser_bench = subparsers.add_parser('bench')
+    bench_subparsers = parser_bench.add_subparsers(dest="bench", required=True)
+    parser_bench_boot = bench_subparsers.add_parser('boot', parents=[parent_parser])
+    parser_bench_boot.add_argument('-n', '--name', help="setup vm name, rootfs overlay is <name>.qcow2")
+    parser_bench_boot.add_argument('--runs', default=5, help="setup boot times, default is 5")
+    parser_bench_boot.add_argument('--timeout', default=300, help="setup timeout seconds of each boot")
+    parser_bench_boot.add_argument('--vmcpu', help="setup vm vcpu number")
+    parser_bench_boot.add_argument('--vmram', help="setup vm ram")
+    parser_bench_boot.add_argument('--kernel', help="setup kernel image, default is built bzImage/Image")
+    parser_bench_boot.add_argument('--append', help="append kernel cmdline")
+    parser_bench_boot.add_argument('--busybox', help="setup static busybox for initramfs")
+    parser_bench_boot.add_argument('-o', '--output', help="setup json report, default is <workdir>/kdev-bench-boot.json")
+    parser_bench_boot.set_defaults(func=handle_bench_boot)
+    parser_bench_build = bench_subparsers.add_parser('build', parents=[parent_parser])
+    parser_bench_build.add_argument("--nodocker", default=None, action="store_true",
+                                    help="build kernel without docker environment")
+    parser_bench_build.add_argument("-j", "--job", default=None, help="setup N of the -j sweep, default is cpu count")
+    parser_bench_build.add_argument("--jobs", default=None, help="setup -j sweep, e.g. 1,8,16")
+    parser_bench_build.add_argument("--scenarios", default="clean,noop,touch,jobs",
+                                    help="setup scenarios, default is clean,noop,touch,jobs")
+    parser_bench_build.add_argument("--touch", default="init/main.c",
+                                    help="setup file touched by touch scenario, default is init/main.c")
+    parser_bench_build.add_argument("--config", help="setup kernel build config")
+    parser_bench_build.add_argument("--warm", default=None, action="store_true",
+                                    help="build in a per-workdir container kept alive between builds")
+    parser_bench_build.add_argument('-o', '--output',
+                                    help="setup json report, default is <workdir>/bench/kdev-bench-build.json")
+    parser_bench_build.set_defaults(func=handle_bench_build, ccache=None, ccache_dir=None, ccache_size="20G",
+                                    warm_timeout=1800, rebuild=None, quiet=True, artifact_cache=None,
+                                    module_compress=None, deploy=None, tmpfs=None, metrics_dir=None,
+                                    matrix=None)
+
+    # 添加子命令 log
+    parser_log = subparsers.add_parser('log', parents=[parent_parser])
+    parser_log.add_argument('--errors', default=None, action="store_true",
+                            help="only show the first error and failed target of failed phases")
+    parser_log.add_argument('-b', '--build', help="setup build log id in <workdir>/logs, default is latest")
+    parser_log.add_argument('-p', '--phase', help="only show the log of this phase")
+    parser_log.add_argument('-C', '--context', default=10, help="setup context lines around the error")
+    parser_log.set_defaults(func=handle_log)
+
     # 添加子命令 clean
     parser_clean = subparsers.add_parser('clean', parents=[parent_parser])
     parser_clean.add_argument('--vm', default=None, action="store_true", help="clean vm (destroy/undefine)")
-    parser_clean.add_argument('--qcow', default=None, action="store_true", help="delete qcow")
+    parser_clean.add_argument('-n', '--name', help="setup vm name")
+    parser_clean.add_argument('--qcow', default=None, action="store_true", help="delete qcow overlay")
+    parser_clean.add_argument('--base', default=None, action="store_true", help="delete downloaded qcow")
     parser_clean.add_argument('--docker', default=None, action="store_true", help="clean docker")
+    parser_clean.add_argument('--tmpfs', default=None, action="store_true", help="umount tmpfs object tree")
     parser_clean.add_argument('--all', default=None, action="store_true", help="clean all")
     parser_clean.set_defaults(func=handle_clean)
 
@@ -994,6 +3621,7 @@ def main():
     parser_image_group = parser_image.add_mutually_exclusive_group(required=True)
     parser_image_group.add_argument('-m', '--mount', metavar='QCOW2_FILE_PATH', help="mount qcow2")
     parser_image_group.add_argument('-u', '--umount', metavar='QCOW2_FILE_PATH', help="umount qcow2")
+    parser_image.add_argument('--trace', default=None, help="write a chrome trace event json of this run")
     parser_image_group.set_defaults(func=handle_image)
 
     # 开始解析命令
@@ -1034,7 +3662,12 @@ def main():
         parser.print_help()
         sys.exit(0)
     else:
-        args.func(args)
+        if getattr(args, "trace", None):
+            TRACE_EVENTS = []
+            # 先注册，atexit逆序执行，nbd释放等清理也会记录
+            atexit.register(do_trace_save, os.path.abspath(args.trace))
+        with do_trace_span(args.func.__name__, "kdev", argv=sys.argv[1:]):
+            args.func(args)
 
 
 if __name__ == "__main__":